@@ -0,0 +1,257 @@
+""" Бенчмарк расчетов и рендера: p50/p99 задержки и пиковая память по этапам.
+
+    python benchmark.py --output bench.json
+    python benchmark.py --compare bench.json   # сравнение p50 с прошлым прогоном
+    python benchmark.py --sessions             # конкуренция потоков за хранилище сессий
+"""
+import argparse
+import itertools
+import json
+import platform
+import random
+import sys
+import threading
+import time
+import tracemalloc
+from datetime import datetime, timezone
+
+import numpy as np
+
+import dice_engine
+from dice_distribution import DiceDistribution
+from dice_notation import parse_dice_notation
+from params import ADVANTAGE_TYPES
+from session_manager import SessionManager
+
+# Нагрузки: (название, бросок атаки, бросок урона)
+WORKLOADS = (
+    ('trivial', '+5', '+5'),
+    ('typical', '1d4 + 5', '2d6 + 4'),
+    ('heavy', '2d4 + 7', '20d6 + 10d8'),
+)
+
+# Этапы в порядке выполнения: каждый замеряет только свою часть,
+# результаты предыдущих этапов к этому моменту уже закэшированы в объекте
+STAGES = {
+    'parse': lambda dist: (parse_dice_notation(dist.to_hit_roll), parse_dice_notation(dist.damage_roll)),
+    'to_hit_modifiers_distribution': lambda dist: dist.to_hit_modifiers_distribution(),
+    'damage_distribution': lambda dist: dist.damage_distribution,
+    'damage_vs_ac_distribution': lambda dist: dist.damage_vs_ac_distribution,
+    'plot_to_hit_distribution': lambda dist: dist.plot_to_hit_distribution(),
+    'plot_damage_distribution': lambda dist: dist.plot_damage_distribution('normal'),
+    'plot_average_damage_vs_ac': lambda dist: dist.plot_average_damage_vs_ac(),
+    'render_charts_fast': lambda dist: dist.render_charts(renderer='fast', preset='telegram'),
+}
+
+PLOT_STAGES = ('plot_to_hit_distribution', 'plot_damage_distribution',
+               'plot_average_damage_vs_ac', 'render_charts_fast')
+
+
+def clear_caches():
+    """Сбрасывает мемоизацию скомпилированных кубов, чтобы замерять холодный расчет"""
+    dice_engine.compiled_die.cache_clear()
+    dice_engine.term_distribution.cache_clear()
+
+
+def workload_cases():
+    for (name, to_hit, damage), gwf, advantage in itertools.product(WORKLOADS, (False, True), ADVANTAGE_TYPES):
+        case = f"{name}/gwf={'on' if gwf else 'off'}/{ADVANTAGE_TYPES[advantage].lower().replace(' ', '_')}"
+        yield case, {
+            'to_hit_roll': to_hit,
+            'damage_roll': damage,
+            'great_weapon_fighting_active': gwf,
+            'advantage_status': advantage
+        }
+
+
+def run_stages(params, stages, warm):
+    """Один прогон всех этапов на новом объекте: {этап: секунды}"""
+    if not warm:
+        clear_caches()
+
+    dist = DiceDistribution(**params)
+    timings = {}
+    for stage in stages:
+        start = time.perf_counter()
+        STAGES[stage](dist)
+        timings[stage] = time.perf_counter() - start
+
+    return timings
+
+
+def peak_memory(params, stages, warm):
+    """Пиковая память по этапам (tracemalloc), отдельным прогоном: трассировка искажает время"""
+    if not warm:
+        clear_caches()
+
+    dist = DiceDistribution(**params)
+    peaks = {}
+    tracemalloc.start()
+    for stage in stages:
+        tracemalloc.reset_peak()
+        baseline = tracemalloc.get_traced_memory()[0]
+        STAGES[stage](dist)
+        peaks[stage] = tracemalloc.get_traced_memory()[1] - baseline
+    tracemalloc.stop()
+
+    return peaks
+
+
+def benchmark(repeat=50, plot_repeat=5, warm=False, plots=True, case_filter=None):
+    """ repeat - прогонов расчетных этапов, plot_repeat - прогонов с рендером:
+        графики на порядки медленнее, и полный набор прогонов занимал бы десятки минут
+    """
+    math_stages = [stage for stage in STAGES if stage not in PLOT_STAGES]
+    stages = list(STAGES) if plots else math_stages
+    results = {}
+
+    for case, params in workload_cases():
+        if case_filter and case_filter not in case:
+            continue
+
+        # Первый прогон прогревает импорты и шаблоны графиков и в статистику не входит
+        run_stages(params, stages, warm)
+        samples = {stage: [] for stage in stages}
+        for _ in range(repeat):
+            for stage, seconds in run_stages(params, math_stages, warm).items():
+                samples[stage].append(seconds)
+        if plots:
+            for _ in range(plot_repeat):
+                for stage, seconds in run_stages(params, stages, warm).items():
+                    if stage in PLOT_STAGES:
+                        samples[stage].append(seconds)
+        peaks = peak_memory(params, stages, warm)
+
+        results[case] = {
+            stage: {
+                'runs': len(samples[stage]),
+                'p50_ms': float(np.percentile(samples[stage], 50) * 1000),
+                'p99_ms': float(np.percentile(samples[stage], 99) * 1000),
+                'peak_memory_kb': peaks[stage] / 1024
+            }
+            for stage in stages
+        }
+        print(f'  {case}', file=sys.stderr)
+
+    return {
+        'meta': {
+            'timestamp': datetime.now(timezone.utc).isoformat(timespec='seconds'),
+            'python': platform.python_version(),
+            'numpy': np.__version__,
+            'platform': platform.platform(),
+            'repeat': repeat,
+            'plot_repeat': plot_repeat if plots else 0,
+            'warm_caches': warm
+        },
+        'results': results
+    }
+
+
+def session_benchmark(threads=16, operations=20000, users=10000, stripes=(1, 64)):
+    """ Пропускная способность SessionManager под конкурентной нагрузкой.
+        Каждая операция повторяет обновление в боте: три проверки шага фильтрами,
+        чтение данных и запись в каждом четвертом обновлении
+    """
+    results = {}
+
+    for stripe_count in stripes:
+        sessions = SessionManager(stripes=stripe_count)
+        for user_id in range(users):
+            sessions.update_session(user_id, step='adjusting_parameters', last_bot_message_id=0)
+
+        barrier = threading.Barrier(threads + 1)
+        latencies = []
+
+        def worker(seed):
+            rng = random.Random(seed)
+            samples = []
+            barrier.wait()
+            for index in range(operations):
+                user_id = rng.randrange(users)
+                start = time.perf_counter()
+                for _ in range(3):
+                    sessions.get_user_step(user_id)
+                sessions.get_user_data(user_id)
+                if index % 4 == 0:
+                    sessions.update_session(user_id, step='adjusting_parameters', last_bot_message_id=index)
+                samples.append(time.perf_counter() - start)
+            latencies.extend(samples)
+
+        workers = [threading.Thread(target=worker, args=(seed,)) for seed in range(threads)]
+        for thread in workers:
+            thread.start()
+        barrier.wait()
+        start = time.perf_counter()
+        for thread in workers:
+            thread.join()
+        elapsed = time.perf_counter() - start
+
+        results[f'stripes={stripe_count}'] = {
+            'threads': threads,
+            'operations': threads * operations,
+            'ops_per_second': threads * operations / elapsed,
+            'p50_us': float(np.percentile(latencies, 50) * 1e6),
+            'p99_us': float(np.percentile(latencies, 99) * 1e6)
+        }
+        print(f"  stripes={stripe_count:<4}{results[f'stripes={stripe_count}']['ops_per_second']:12.0f} ops/s", file=sys.stderr)
+
+    return {
+        'meta': {
+            'timestamp': datetime.now(timezone.utc).isoformat(timespec='seconds'),
+            'python': platform.python_version(),
+            'platform': platform.platform()
+        },
+        'sessions': results
+    }
+
+
+def print_report(report, baseline=None, stream=sys.stderr):
+    header = f"{'case':36}{'stage':32}{'p50 ms':>10}{'p99 ms':>10}{'peak KB':>10}"
+    if baseline:
+        header += f"{'p50 Δ':>9}"
+    print(header, file=stream)
+
+    for case, stages in report['results'].items():
+        for stage, stats in stages.items():
+            line = f"{case:36}{stage:32}{stats['p50_ms']:10.3f}{stats['p99_ms']:10.3f}{stats['peak_memory_kb']:10.1f}"
+            previous = (baseline or {}).get('results', {}).get(case, {}).get(stage)
+            if previous and previous['p50_ms'] > 0:
+                line += f"{(stats['p50_ms'] / previous['p50_ms'] - 1) * 100:+8.1f}%"
+            print(line, file=stream)
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Бенчмарк расчетов распределений и рендера графиков')
+    parser.add_argument('--repeat', type=int, default=50, help='прогонов расчетов на нагрузку (по умолчанию 50)')
+    parser.add_argument('--plot-repeat', type=int, default=5, help='прогонов рендера на нагрузку (по умолчанию 5)')
+    parser.add_argument('--warm', action='store_true', help='не сбрасывать мемоизацию кубов между прогонами')
+    parser.add_argument('--no-plots', action='store_true', help='только расчеты, без рендера графиков')
+    parser.add_argument('--filter', help='только нагрузки, в названии которых есть эта строка')
+    parser.add_argument('--output', help='файл для JSON-отчета (по умолчанию stdout)')
+    parser.add_argument('--compare', help='JSON прошлого прогона для сравнения p50')
+    parser.add_argument('--sessions', action='store_true', help='бенчмарк хранилища сессий вместо расчетов')
+    parser.add_argument('--threads', type=int, default=16, help='потоков в бенчмарке сессий (по умолчанию 16)')
+    args = parser.parse_args()
+
+    if args.sessions:
+        report = session_benchmark(threads=args.threads)
+    else:
+        report = benchmark(args.repeat, args.plot_repeat, warm=args.warm, plots=not args.no_plots,
+                           case_filter=args.filter)
+
+        baseline = None
+        if args.compare:
+            with open(args.compare, encoding='utf-8') as file:
+                baseline = json.load(file)
+        print_report(report, baseline)
+
+    if args.output:
+        with open(args.output, 'w', encoding='utf-8') as file:
+            json.dump(report, file, indent=2, ensure_ascii=False)
+    else:
+        json.dump(report, sys.stdout, indent=2, ensure_ascii=False)
+        print()
+
+
+if __name__ == '__main__':
+    main()
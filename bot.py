@@ -1,34 +1,105 @@
-import telebot
-from telebot.types import ReplyKeyboardRemove, InlineKeyboardButton, InlineKeyboardMarkup 
-
-from config import BOT_TOKEN
-from dice_distribution import DiceDistribution
+import time
+
+# Отсчет времени запуска до импорта библиотек: telebot и aiohttp сами по себе грузятся заметное время
+STARTED_AT = time.perf_counter()
+
+import asyncio
+from concurrent.futures.process import BrokenProcessPool
+
+from telebot.async_telebot import AsyncTeleBot
+from telebot.asyncio_helper import ApiTelegramException
+from telebot.types import ReplyKeyboardRemove, InlineKeyboardButton, InlineKeyboardMarkup, InputMediaPhoto
+
+from config import (ADMIN_USER_IDS, BOT_MODE, BOT_TOKEN, CALCULATE_LIMIT_CONFIG, FILE_ID_STORE_MAX_ENTRIES,
+                    FILE_ID_STORE_PATH, METRICS_CONFIG, RENDER_POOL_CONFIG, RESULT_CACHE_CONFIG,
+                    SESSION_BACKEND_CONFIG, SESSION_CONFIG, WEBHOOK_CONFIG)
+from file_id_store import FileIdStore
+from metrics import Metrics, start_metrics_server
+from rate_limiter import RequestLimiter
+from render_pool import RenderPool, RenderPoolBusy
+from result_cache import ResultCache, cache_key_hash, make_cache_key, result_layout
+from session_backends import create_session_backend
 from session_manager import SessionManager
+from state_dispatcher import (TEXT_EVENT, StateDispatcher, build_parameter_transitions, callback_event,
+                              editing_step)
 
 from keyboard_utils import create_adv_type_menu, create_parameters_menu
-from params import ADVANTAGE_TYPES, PARAMETERS
-from text_utils import generate_parameters_text, generate_welcome_text, generate_help_text
-
-bot = telebot.TeleBot(BOT_TOKEN)
-
-# Храним состояние пользователей
-session_handler = SessionManager()
+from params import (ADVANTAGE_TYPES, CHART_CAPTIONS, MAX_SWEEP_VARIANTS, PARAMETERS, calculation_budget_error,
+                    parse_sweep_grid, sweep_variant_label)
+from text_utils import generate_parameters_text, generate_welcome_text, generate_help_text, generate_sweep_text
+
+bot = AsyncTeleBot(BOT_TOKEN)
+
+# Храним состояние пользователей: в памяти и, если настроено, в SQLite или Redis
+session_handler = SessionManager(
+    **SESSION_CONFIG,
+    backend=create_session_backend(**SESSION_BACKEND_CONFIG, session_timeout=SESSION_CONFIG['session_timeout'])
+)
+
+# Общий для всех пользователей кэш готовых расчетов
+result_cache = ResultCache(**RESULT_CACHE_CONFIG)
+
+# file_id уже загруженных в Telegram графиков, чтобы не загружать их повторно
+file_id_store = FileIdStore(FILE_ID_STORE_PATH, max_entries=FILE_ID_STORE_MAX_ENTRIES)
+
+# Пул процессов для расчетов и рендера графиков
+render_pool = RenderPool(**RENDER_POOL_CONFIG)
+
+# Выбор обработчика по шагу диалога и событию; шаги ввода параметров строятся по PARAMETERS
+dispatcher = StateDispatcher(session_handler.get_user_step)
+PARAMETER_TRANSITIONS = build_parameter_transitions(PARAMETERS)
+ADVANTAGE_EVENT = PARAMETERS['advantage_status']['callback_prefix']
+
+# Секунды от старта процесса: ready - бот принимает обновления, warm_up - воркеры и расчеты прогреты
+startup_timings = {}
+
+# Лимиты кнопки расчета и расчеты, которые выполняются прямо сейчас:
+# {(user_id, хэш параметров, способ отправки): задача}
+calculate_limiter = RequestLimiter(**CALCULATE_LIMIT_CONFIG)
+pending_calculations = {}
+
+# Гистограммы задержек обработчиков и этапов расчета, счетчики и состояние кэшей
+metrics = Metrics()
+metrics.describe('handler_seconds', 'Время выполнения обработчиков бота')
+metrics.describe('handler_errors_total', 'Исключения в обработчиках бота')
+metrics.describe('stage_seconds', 'Время этапов расчета: parse, distribution, render, draw, encode, render_pool, upload')
+metrics.describe('calculations_total', 'Запросы расчета по источнику результата')
+metrics.describe('render_errors_total', 'Ошибки расчета и рендера в пуле')
+metrics.describe('calculations_shed_total',
+                 'Отклоненные запросы расчета: rate - лимит пользователя, busy - перегрузка, budget - сверх бюджета')
+metrics.gauge('sessions', 'Активные сессии', lambda: len(session_handler))
+metrics.gauge('result_cache_entries', 'Записей в кэше результатов', lambda: result_cache.stats()['entries'])
+metrics.gauge('result_cache_bytes', 'Размер кэша результатов в байтах', lambda: result_cache.stats()['bytes'])
+metrics.gauge('result_cache_hit_ratio', 'Доля попаданий в кэш результатов', lambda: result_cache.stats()['hit_rate'])
+metrics.gauge('calculations_in_flight', 'Выполняемые расчеты', lambda: calculate_limiter.active)
+metrics.gauge('startup_seconds', 'Время запуска бота до приема обновлений',
+              lambda: startup_timings.get('ready', 0.0))
+metrics.gauge('warm_up_seconds', 'Время прогрева воркеров рендера и модулей расчета',
+              lambda: startup_timings.get('warm_up', 0.0))
+metrics.gauge('file_id_store_entries', 'Расчетов с сохраненными file_id', lambda: len(file_id_store))
+
+# AC для тепловой карты /compare и для ее текстовой версии
+SWEEP_AC_VALUES = range(10, 26)
+SWEEP_TEXT_AC_VALUES = (12, 14, 16, 18, 20)
 
 
 @bot.message_handler(commands=['start'])
-def send_welcome(message):
+@metrics.instrument_handler
+async def send_welcome(message):
     welcome_text = generate_welcome_text()
-    bot.send_message(message.chat.id, welcome_text, parse_mode='html')
+    await bot.send_message(message.chat.id, welcome_text, parse_mode='html')
 
 
 @bot.message_handler(commands=['help'])
-def send_help(message):
+@metrics.instrument_handler
+async def send_help(message):
     help_text = generate_help_text()
-    bot.send_message(message.chat.id, help_text, parse_mode='html')
+    await bot.send_message(message.chat.id, help_text, parse_mode='html')
 
 
 @bot.message_handler(commands=['new_calc', 'reset'])
-def create_new_calc(message):
+@metrics.instrument_handler
+async def create_new_calc(message):
     user_id = message.from_user.id
 
     # Создаем словарь с дефолтными значениями всех параметров
@@ -47,7 +118,7 @@ def create_new_calc(message):
         Выберите 🔄 Тип броска:
     """
 
-    msg = bot.send_message(
+    msg = await bot.send_message(
         message.chat.id,
         text,
         reply_markup=create_adv_type_menu()
@@ -56,33 +127,94 @@ def create_new_calc(message):
     session_handler.update_session(user_id, last_bot_message_id=msg.message_id)
 
 
-@bot.message_handler(func=lambda message: session_handler.get_user_step(message.from_user.id) is None)
-def handle_no_session(message):
-    bot.send_message(
+@bot.message_handler(commands=['metrics'], func=lambda message: message.from_user.id in ADMIN_USER_IDS)
+@metrics.instrument_handler
+async def send_metrics(message):
+    """Админ-команда: p50/p99 обработчиков и этапов, сессии и кэши"""
+    await bot.send_message(message.chat.id, metrics.summary(), parse_mode='html')
+
+
+@bot.message_handler(commands=['compare'])
+@metrics.instrument_handler
+async def compare_variants(message):
+    """Сравнение вариантов билда: таблица или тепловая карта среднего урона по AC"""
+    user_id = message.from_user.id
+    chat_id = message.chat.id
+    user_data = session_handler.get_user_data(user_id)
+
+    if not user_data or not user_data.get('to_hit_roll'):
+        await bot.send_message(chat_id, "❌ Сначала задайте бросок атаки через /new_calc")
+        return
+
+    grid = parse_sweep_grid(message.text.partition(' ')[2])
+    if grid is None:
+        await bot.send_message(
+            chat_id,
+            "❌ Некорректные варианты. Пример: <code>/compare hit=0,1 dmg=0,2 adv=0,1</code>\n"
+            f"Параметры: hit, dmg, adv, gwf, hl, crit; не больше {MAX_SWEEP_VARIANTS} вариантов",
+            parse_mode='html'
+        )
+        return
+
+    from dice_distribution import build_sweep_variants
+
+    variants = build_sweep_variants(grid)
+    labels = [sweep_variant_label(variant) for variant in variants]
+    base_params = get_calculation_parameters(user_data)
+
+    if user_data.get('chart_delivery') == 'text':
+        from dice_distribution import sweep_expected_damage
+
+        ac_values = list(SWEEP_TEXT_AC_VALUES)
+        matrix = await asyncio.to_thread(sweep_expected_damage, base_params, variants, ac_values)
+        await bot.send_message(chat_id, generate_sweep_text(labels, ac_values, matrix), parse_mode='html')
+        return
+
+    try:
+        future = render_pool.submit_sweep(base_params, variants, SWEEP_AC_VALUES, labels)
+    except RenderPoolBusy:
+        await bot.send_message(chat_id, "⏳ Бот сейчас перегружен, попробуйте через минуту")
+        return
+    except BrokenProcessPool as e:
+        print(f"❌ Пул рендера недоступен: {e}")
+        await bot.send_message(chat_id, "❌ Не удалось построить сравнение, попробуйте еще раз")
+        return
+
+    await handle_sweep_result(future, chat_id)
+
+
+@dispatcher.route(TEXT_EVENT, steps=[None])
+@metrics.instrument_handler
+async def handle_no_session(message):
+    await bot.send_message(
         message.chat.id,
         "👋 Привет! Для начала работы используйте команду /start"
     )
 
 
-@bot.callback_query_handler(func=lambda call: call.data.startswith('set_adv_type:') and session_handler.get_user_step(call.from_user.id) in ('choosing_advantage', 'editing_advantage'))
-def handle_advantage_choice(call):
-    bot.answer_callback_query(call.id)
-
+@dispatcher.route(ADVANTAGE_EVENT, steps=['choosing_advantage'] + [step for step, event in PARAMETER_TRANSITIONS.items() if event == ADVANTAGE_EVENT])
+@metrics.instrument_handler
+async def handle_advantage_choice(call):
     user_id = call.from_user.id
     chat_id = call.message.chat.id
+    current_step, user_data = session_handler.get_step_and_data(user_id)
 
-    bot.delete_message(chat_id, session_handler.get_user_data(user_id, 'last_bot_message_id'))
+    # Ответ на callback и удаление прошлого сообщения не зависят друг от друга
+    await asyncio.gather(
+        bot.answer_callback_query(call.id),
+        bot.delete_message(chat_id, user_data.get('last_bot_message_id'))
+    )
 
-    advantage_status = int(call.data.replace('set_adv_type:', ''))
+    advantage_status = int(call.data.partition(':')[2])
 
-    if session_handler.get_user_step(call.from_user.id) == 'editing_advantage':
+    if current_step == editing_step('advantage_status'):
         session_handler.update_session(
             user_id,
             step='adjusting_parameters',
             advantage_status=advantage_status
         )
 
-        show_parameters(user_id, chat_id)
+        await show_parameters(user_id, chat_id)
     else:
         session_handler.update_session(
             user_id,
@@ -90,7 +222,7 @@ def handle_advantage_choice(call):
             advantage_status=advantage_status
         )
 
-        msg = bot.send_message(
+        msg = await bot.send_message(
             call.message.chat.id,
             f"✅ Выбран тип броска: <b>{ADVANTAGE_TYPES[advantage_status]}</b>\n\n"
             "Теперь введите модификаторы броска на попадание (без d20):\n"
@@ -101,18 +233,19 @@ def handle_advantage_choice(call):
         session_handler.update_session(user_id, last_bot_message_id=msg.message_id)
 
 
-@bot.message_handler(func=lambda message: session_handler.get_user_step(message.from_user.id) == 'entering_to_hit')
-def handle_to_hit_input(message):
+@dispatcher.route(TEXT_EVENT, steps=['entering_to_hit'])
+@metrics.instrument_handler
+async def handle_to_hit_input(message):
     user_id = message.from_user.id
     chat_id = message.chat.id
 
-    bot.delete_message(chat_id, session_handler.get_user_data(user_id, 'last_bot_message_id'))
+    await bot.delete_message(chat_id, session_handler.get_user_data(user_id, 'last_bot_message_id'))
 
     param_data = PARAMETERS['to_hit_roll']
     is_valid = param_data['validator'](message.text)
     if not is_valid:
         error_text = param_data['error_text']
-        msg = bot.send_message(chat_id, error_text, parse_mode='html')
+        msg = await bot.send_message(chat_id, error_text, parse_mode='html')
         session_handler.update_session(user_id, last_bot_message_id=msg.message_id)
         return  # Не сохраняем невалидное значение
 
@@ -129,7 +262,7 @@ def handle_to_hit_input(message):
         InlineKeyboardButton('❌ Нет', callback_data='add_damage_roll:0')
     )
 
-    msg = bot.send_message(
+    msg = await bot.send_message(
         message.chat.id,
         f"✅ To-Hit Roll сохранен: <code>{message.text}</code>\n\n"
         "Добавить бросок урона (Damage Roll)?",
@@ -140,15 +273,18 @@ def handle_to_hit_input(message):
     session_handler.update_session(user_id, last_bot_message_id=msg.message_id)
 
 
-@bot.callback_query_handler(func=lambda call: call.data.startswith('add_damage_roll:') and session_handler.get_user_step(call.from_user.id) == 'choosing_to_enter_damage')
-def handle_damage_choice(call):
+@dispatcher.route('add_damage_roll', steps=['choosing_to_enter_damage'])
+@metrics.instrument_handler
+async def handle_damage_choice(call):
     """Обработка выбора Damage Roll"""
-    bot.answer_callback_query(call.id)
-
     user_id = call.from_user.id
     chat_id = call.message.chat.id
 
-    bot.delete_message(chat_id, session_handler.get_user_data(user_id, 'last_bot_message_id'))
+    # Ответ на callback и удаление прошлого сообщения не зависят друг от друга
+    await asyncio.gather(
+        bot.answer_callback_query(call.id),
+        bot.delete_message(chat_id, session_handler.get_user_data(user_id, 'last_bot_message_id'))
+    )
 
     if call.data == 'add_damage_roll:1':
         session_handler.update_session(
@@ -156,7 +292,7 @@ def handle_damage_choice(call):
             step='entering_damage_roll'
         )
 
-        msg = bot.send_message(
+        msg = await bot.send_message(
             call.message.chat.id,
             "Введите бросок урона (Damage Roll):\nПример: <code>2d6 + 3</code>",
             parse_mode='html',
@@ -171,22 +307,23 @@ def handle_damage_choice(call):
             user_id,
             step='adjusting_parameters'
         )
-        show_parameters(user_id, call.message.chat.id)
+        await show_parameters(user_id, call.message.chat.id)
 
 
-@bot.message_handler(func=lambda message: session_handler.get_user_step(message.from_user.id) == 'entering_damage_roll')
-def handle_damage_input(message):
+@dispatcher.route(TEXT_EVENT, steps=['entering_damage_roll'])
+@metrics.instrument_handler
+async def handle_damage_input(message):
     """Шаг 3a: Обработка ввода Damage Roll"""
     user_id = message.from_user.id
     chat_id = message.chat.id
 
-    bot.delete_message(chat_id, session_handler.get_user_data(user_id, 'last_bot_message_id'))
+    await bot.delete_message(chat_id, session_handler.get_user_data(user_id, 'last_bot_message_id'))
 
     param_data = PARAMETERS['damage_roll']
     is_valid = param_data['validator'](message.text)
     if not is_valid:
         error_text = param_data['error_text']
-        msg = bot.send_message(chat_id, error_text, parse_mode='html')
+        msg = await bot.send_message(chat_id, error_text, parse_mode='html')
         session_handler.update_session(user_id, last_bot_message_id=msg.message_id)
         return  # Не сохраняем невалидное значение
 
@@ -196,17 +333,20 @@ def handle_damage_input(message):
         damage_roll=message.text
     )
 
-    show_parameters(user_id, message.chat.id)
-
+    await show_parameters(user_id, message.chat.id)
 
-@bot.callback_query_handler(func=lambda call: call.data.startswith('param_change:'))
-def handle_parameter_change(call):
-    bot.answer_callback_query(call.id)
 
+@dispatcher.route('param_change')
+@metrics.instrument_handler
+async def handle_parameter_change(call):
     user_id = call.from_user.id
     chat_id = call.message.chat.id
 
-    bot.delete_message(chat_id, session_handler.get_user_data(user_id, 'last_bot_message_id'))
+    # Ответ на callback и удаление прошлого сообщения не зависят друг от друга
+    await asyncio.gather(
+        bot.answer_callback_query(call.id),
+        bot.delete_message(chat_id, session_handler.get_user_data(user_id, 'last_bot_message_id'))
+    )
 
     param_slug = call.data.split(':')[1]
     param_type = PARAMETERS[param_slug]['type']
@@ -218,18 +358,29 @@ def handle_parameter_change(call):
             user_id,
             **{param_slug: new_value}
         )
-        show_parameters(user_id, chat_id)
+        await show_parameters(user_id, chat_id)
+
+    elif param_type == 'choice':
+        # Переключаем на следующий вариант по кругу
+        options = list(PARAMETERS[param_slug]['options'])
+        current_value = session_handler.get_user_data(user_id, param_slug)
+        current_index = options.index(current_value) if current_value in options else -1
+        session_handler.update_session(
+            user_id,
+            **{param_slug: options[(current_index + 1) % len(options)]}
+        )
+        await show_parameters(user_id, chat_id)
 
     elif param_type == 'user_text':  # изменить условие: параметр вводится со строки
         # принять сообщение с новым значением параметра
         session_handler.update_session(
             user_id,
-            step=f'editing_{param_slug}'
+            step=editing_step(param_slug)
         )
 
         text = f"Введите новое значение для {PARAMETERS[param_slug]['short_name']}:"
 
-        msg = bot.send_message(
+        msg = await bot.send_message(
             chat_id,
             text,
             parse_mode='html'
@@ -241,10 +392,10 @@ def handle_parameter_change(call):
         # Меняем advantage (единственный параметр, который вводится с inline кнопки)
         session_handler.update_session(
             user_id,
-            step='editing_advantage'
+            step=editing_step(param_slug)
         )
 
-        msg = bot.send_message(
+        msg = await bot.send_message(
             call.message.chat.id,
             "Выберите новый тип броска:",
             reply_markup=create_adv_type_menu()
@@ -253,22 +404,23 @@ def handle_parameter_change(call):
         session_handler.update_session(user_id, last_bot_message_id=msg.message_id)
 
 
-@bot.message_handler(func=lambda message: session_handler.get_user_step(message.from_user.id).startswith('editing_'))
-def handle_parameter_text_input(message):
+@dispatcher.route(TEXT_EVENT, steps=[step for step, event in PARAMETER_TRANSITIONS.items() if event == TEXT_EVENT])
+@metrics.instrument_handler
+async def handle_parameter_text_input(message):
     user_id = message.from_user.id
     chat_id = message.chat.id
-    current_step = session_handler.get_user_step(user_id)
+    current_step, user_data = session_handler.get_step_and_data(user_id)
 
-    bot.delete_message(chat_id, session_handler.get_user_data(user_id, 'last_bot_message_id'))
+    await bot.delete_message(chat_id, user_data.get('last_bot_message_id'))
 
-    param_slug = current_step.replace('editing_', '')
+    param_slug = current_step.removeprefix('editing_')
     param_data = PARAMETERS[param_slug]
 
     if 'validator' in param_data:
         is_valid = param_data['validator'](message.text)
         if not is_valid:
             error_text = param_data['error_text']
-            msg = bot.send_message(chat_id, error_text, parse_mode='html')
+            msg = await bot.send_message(chat_id, error_text, parse_mode='html')
             session_handler.update_session(user_id, last_bot_message_id=msg.message_id)
             return  # Не сохраняем невалидное значение
 
@@ -278,7 +430,7 @@ def handle_parameter_text_input(message):
             new_value = param_data['converter'](message.text)
         except (ValueError, TypeError) as e:
             error_text = param_data['error_text']
-            msg = bot.send_message(chat_id, error_text, parse_mode='html')
+            msg = await bot.send_message(chat_id, error_text, parse_mode='html')
             session_handler.update_session(user_id, last_bot_message_id=msg.message_id)
             return
 
@@ -288,13 +440,12 @@ def handle_parameter_text_input(message):
         **{param_slug: new_value}
     )
 
-    show_parameters(user_id, chat_id)
-
+    await show_parameters(user_id, chat_id)
 
-@bot.callback_query_handler(func=lambda call: call.data.startswith('calculate'))
-def show_graphs(call):
-    bot.answer_callback_query(call.id)
 
+@dispatcher.route('calculate')
+@metrics.instrument_handler
+async def show_graphs(call):
     user_id = call.from_user.id
     chat_id = call.message.chat.id
 
@@ -305,32 +456,205 @@ def show_graphs(call):
 
     user_data = session_handler.get_user_data(user_id)
 
-    dice_dist = DiceDistribution(**{
-            param: user_data.get(param, PARAMETERS[param]['default'])
-            for param in PARAMETERS.keys()
-    })
+    # Поля проверены по отдельности, но вместе (кубы всех атак раунда) могут не уложиться в бюджет
+    budget_error = calculation_budget_error(get_calculation_parameters(user_data))
+    if budget_error:
+        metrics.increment('calculations_shed_total', reason='budget')
+        await asyncio.gather(bot.answer_callback_query(call.id), bot.send_message(chat_id, budget_error))
+        return
+
+    delivery = user_data.get('chart_delivery', PARAMETERS['chart_delivery']['default'])
+    cache_key = make_cache_key(user_data, result_layout(delivery))
+    key_hash = cache_key_hash(cache_key)
+
+    # Повторное нажатие присоединяется к уже идущему расчету, а не запускает новый
+    pending_key = (user_id, key_hash, delivery)
+    pending = pending_calculations.get(pending_key)
+    if pending is not None:
+        metrics.increment('calculations_total', source='joined')
+        await asyncio.gather(
+            bot.answer_callback_query(call.id, "⏳ Уже считаю, графики скоро будут"),
+            asyncio.wait([pending])
+        )
+        return
+
+    if not calculate_limiter.allow(user_id):
+        metrics.increment('calculations_shed_total', reason='rate')
+        await bot.answer_callback_query(call.id, "⏳ Слишком часто, подождите пару секунд")
+        return
+
+    if not calculate_limiter.try_acquire():
+        metrics.increment('calculations_shed_total', reason='busy')
+        await bot.answer_callback_query(call.id, "⏳ Бот сейчас перегружен, попробуйте через минуту")
+        return
+
+    answering = asyncio.create_task(bot.answer_callback_query(call.id))
+    calculation = asyncio.create_task(process_calculation(chat_id, user_data, cache_key, key_hash, delivery))
+    pending_calculations[pending_key] = calculation
+    try:
+        await calculation
+    finally:
+        del pending_calculations[pending_key]
+        calculate_limiter.release()
+        await answering
+
+
+async def process_calculation(chat_id, user_data, cache_key, key_hash, delivery):
+    """Отправляет результат расчета: из file_id, из кэша или после рендера в пуле"""
+    if delivery == 'text':
+        metrics.increment('calculations_total', source='text')
+        await send_text_summary(chat_id, cache_key, user_data)
+        return
+
+    # Графики, которые уже загружались в Telegram, отправляем по file_id
+    sent_charts = set()
+    file_ids = file_id_store.get(key_hash)
+    if file_ids:
+        try:
+            with metrics.timer('stage_seconds', stage='upload'):
+                await deliver_charts(chat_id, file_ids, delivery, sent_charts)
+            metrics.increment('calculations_total', source='file_id')
+            return
+        except ApiTelegramException:
+            await asyncio.to_thread(file_id_store.discard, key_hash)
+
+    charts = result_cache.get(cache_key)
+    if charts is not None:
+        metrics.increment('calculations_total', source='cache')
+        await send_charts(chat_id, key_hash, charts, delivery, sent_charts)
+        return
+
+    # Расчет и рендер уходят в пул процессов, цикл событий в это время обслуживает других пользователей
+    metrics.increment('calculations_total', source='render')
+    submitted = time.perf_counter()
+    try:
+        future = render_pool.submit(
+            get_calculation_parameters(user_data),
+            layout=result_layout(delivery)
+        )
+    except RenderPoolBusy:
+        await bot.send_message(chat_id, "⏳ Бот сейчас перегружен, попробуйте через минуту")
+        return
+    except BrokenProcessPool as e:
+        print(f"❌ Пул рендера недоступен: {e}")
+        metrics.increment('render_errors_total')
+        await bot.send_message(chat_id, "❌ Не удалось построить графики, попробуйте еще раз")
+        return
+
+    await handle_render_result(future, chat_id, cache_key, key_hash, delivery, sent_charts, submitted)
 
-    to_hit_img = dice_dist.plot_to_hit_distribution()
-    bot.send_photo(chat_id, to_hit_img, caption="🎯 To-Hit Distribution")
 
-    if dice_dist.damage_roll.strip():
-        normal_dmg_img = dice_dist.plot_damage_distribution('normal')
-        bot.send_photo(chat_id,
-                       normal_dmg_img,
-                       caption="🩸 Normal Damage Distribution")
+@bot.message_handler(func=lambda message: True)
+async def dispatch_message(message):
+    """Текст вне команд: обработчик выбирается по шагу диалога пользователя"""
+    await dispatcher.dispatch(message, message.from_user.id, TEXT_EVENT)
 
-        crit_dmg_img = dice_dist.plot_damage_distribution('critical')
-        bot.send_photo(chat_id,
-                       crit_dmg_img,
-                       caption="💥 Critical Damage Distribution")
 
-        avg_dmg_vs_ac_img = dice_dist.plot_average_damage_vs_ac()
-        bot.send_photo(chat_id,
-                       avg_dmg_vs_ac_img,
-                       caption="⚔️🛡️ Average Damage vs AC Graph")
+@bot.callback_query_handler(func=lambda call: True)
+async def dispatch_callback(call):
+    """Нажатия кнопок: обработчик выбирается по префиксу callback_data и шагу диалога"""
+    await dispatcher.dispatch(call, call.from_user.id, callback_event(call.data))
 
 
-def show_parameters(user_id: int, chat_id: int):
+def get_calculation_parameters(user_data):
+    """Аргументы DiceDistribution из параметров сессии"""
+    return {
+        param: user_data.get(param, param_data['default'])
+        for param, param_data in PARAMETERS.items()
+        if param_data.get('affects_calculation', True)
+    }
+
+
+def calculate_text_summary(params):
+    """Расчет текстовой сводки; выполняется в пуле потоков, чтобы не блокировать цикл событий"""
+    from dice_distribution import DiceDistribution
+
+    with metrics.timer('stage_seconds', stage='text_summary'):
+        return DiceDistribution(**params).text_summary()
+
+
+async def send_text_summary(chat_id, cache_key, user_data):
+    """Текстовый режим: считаем в процессе бота, без пула рендера и matplotlib"""
+    summary = result_cache.get(cache_key)
+    if summary is not None:
+        await bot.send_message(chat_id, summary, parse_mode='html')
+        return
+
+    summary = await asyncio.to_thread(calculate_text_summary, get_calculation_parameters(user_data))
+    await bot.send_message(chat_id, summary, parse_mode='html')
+    # В кэш - только после успешной отправки: текст, который Telegram не принял, не должен повторяться
+    result_cache.put(cache_key, summary, size=len(summary.encode('utf-8')))
+
+
+async def handle_render_result(future, chat_id, cache_key, key_hash, delivery, sent_charts, submitted):
+    """Кладет результат рендера в кэш и отправляет графики пользователю"""
+    try:
+        result = await asyncio.wrap_future(future)
+    except Exception as e:
+        print(f"❌ Ошибка рендера: {e}")
+        metrics.increment('render_errors_total')
+        await bot.send_message(chat_id, "❌ Не удалось построить графики")
+        return
+    finally:
+        # Время в пуле включает ожидание в очереди и передачу результата между процессами
+        metrics.observe('stage_seconds', time.perf_counter() - submitted, stage='render_pool')
+
+    for stage, seconds in result['timings'].items():
+        metrics.observe('stage_seconds', seconds, stage=stage)
+
+    # В кэше только готовые изображения: их размер и ограничивает кэш
+    result_cache.put(cache_key, result['charts'], size=sum(len(image) for image in result['charts'].values()))
+    await send_charts(chat_id, key_hash, result['charts'], delivery, sent_charts)
+
+
+async def handle_sweep_result(future, chat_id):
+    """Отправляет тепловую карту сравнения вариантов"""
+    try:
+        image = await asyncio.wrap_future(future)
+    except Exception as e:
+        print(f"❌ Ошибка рендера: {e}")
+        await bot.send_message(chat_id, "❌ Не удалось построить сравнение")
+        return
+
+    await bot.send_photo(chat_id, image, caption=CHART_CAPTIONS['sweep'])
+
+
+async def send_charts(chat_id, key_hash, charts, delivery, sent_charts):
+    """Загружает графики в Telegram и запоминает их file_id"""
+    is_complete_upload = not sent_charts
+    with metrics.timer('stage_seconds', stage='upload'):
+        uploaded_file_ids = await deliver_charts(chat_id, charts, delivery, sent_charts)
+
+    if is_complete_upload:
+        # Запись в SQLite с фиксацией транзакции - в пуле потоков
+        await asyncio.to_thread(file_id_store.put, key_hash, uploaded_file_ids)
+
+
+async def deliver_charts(chat_id, charts, delivery, sent_charts):
+    """ Отправляет графики ({тип: PNG или file_id}) отдельными фото или одним альбомом.
+        Отправленные типы добавляются в sent_charts, возвращаются file_id отправленных фото
+    """
+    pending = {chart_type: chart for chart_type, chart in charts.items() if chart_type not in sent_charts}
+
+    if delivery == 'album' and len(pending) > 1:
+        messages = await bot.send_media_group(chat_id, [
+            InputMediaPhoto(chart, caption=CHART_CAPTIONS[chart_type])
+            for chart_type, chart in pending.items()
+        ])
+        sent_charts.update(pending)
+        return {chart_type: msg.photo[-1].file_id for chart_type, msg in zip(pending, messages)}
+
+    # Отдельные фото отправляем по очереди: порядок графиков в чате должен сохраниться
+    file_ids = {}
+    for chart_type, chart in pending.items():
+        msg = await bot.send_photo(chat_id, chart, caption=CHART_CAPTIONS[chart_type])
+        sent_charts.add(chart_type)
+        file_ids[chart_type] = msg.photo[-1].file_id
+
+    return file_ids
+
+
+async def show_parameters(user_id: int, chat_id: int):
     """Шаг 4: Показываем дополнительные параметры для изменения"""
     user_data = session_handler.get_user_data(user_id)
 
@@ -343,16 +667,54 @@ def show_parameters(user_id: int, chat_id: int):
     parameters_text = generate_parameters_text(user_data)
 
     markup = create_parameters_menu()
-    msg = bot.send_message(chat_id, parameters_text, parse_mode='html', reply_markup=markup)
+    msg = await bot.send_message(chat_id, parameters_text, parse_mode='html', reply_markup=markup)
 
     session_handler.update_session(user_id, last_bot_message_id=msg.message_id)
 
 
+def import_calculation_modules():
+    # Текстовый режим и /compare считают в процессе бота: NumPy и движок распределений
+    # загружаются в фоне, чтобы их не ждал первый расчет
+    import dice_distribution  # noqa: F401
+
+
+async def warm_up():
+    """Прогрев после начала приема обновлений: /start и меню параметров работают сразу"""
+    await asyncio.gather(
+        *(asyncio.wrap_future(future) for future in render_pool.warm_up(block=False)),
+        asyncio.to_thread(import_calculation_modules)
+    )
+    startup_timings['warm_up'] = time.perf_counter() - STARTED_AT
+    print(f"🖼️ Воркеры рендера ({render_pool.workers}) готовы за {startup_timings['warm_up']:.2f} с")
+
+
+async def main():
+    warming = asyncio.create_task(warm_up())
+
+    startup_timings['ready'] = time.perf_counter() - STARTED_AT
+    print(f"⏱️ Запуск за {startup_timings['ready']:.2f} с")
+
+    try:
+        if BOT_MODE == 'webhook':
+            from webhook_server import WebhookServer
+
+            print(f"🪝 Вебхук: http://{WEBHOOK_CONFIG['host']}:{WEBHOOK_CONFIG['port']}{WEBHOOK_CONFIG['path']}")
+            await WebhookServer(bot, metrics=metrics, **WEBHOOK_CONFIG).serve_forever()
+        else:
+            await bot.infinity_polling()
+    finally:
+        warming.cancel()
+
+
 if __name__ == "__main__":
     print("🎲 D&D Dice Bot запущен!")
-    print(f"🤖 Активных сессий: {len(session_handler.sessions)}")
+    print(f"🤖 Активных сессий: {len(session_handler)}, хранилище: {SESSION_BACKEND_CONFIG['backend']}")
+
+    if METRICS_CONFIG['port']:
+        start_metrics_server(metrics, **METRICS_CONFIG)
+        print(f"📈 Метрики: http://{METRICS_CONFIG['host']}:{METRICS_CONFIG['port']}/metrics")
 
     try:
-        bot.infinity_polling()
+        asyncio.run(main())
     except Exception as e:
         print(f"❌ Ошибка: {e}")
@@ -0,0 +1,412 @@
+import io
+import threading
+import time
+from typing import Dict
+
+import numpy as np
+from PIL import Image
+from matplotlib.backends.backend_agg import FigureCanvasAgg
+from matplotlib.figure import Figure
+from matplotlib.ticker import MaxNLocator
+
+# Размеры и dpi графиков: tall - двухпанельные графики, wide - урон против AC.
+# palette_colors - число цветов палитры PNG (None - полноцветный RGB)
+RENDER_PRESETS = {
+    'standard': {'tall_figsize': (14, 12), 'wide_figsize': (12, 6), 'dpi': 150, 'palette_colors': 64},
+    # Telegram ужимает фото до 1280 px по большей стороне: та же компоновка, что у standard, без лишних пикселей
+    'telegram': {'tall_figsize': (14, 12), 'wide_figsize': (12, 6), 'dpi': 91, 'palette_colors': 64},
+    'compact': {'tall_figsize': (10, 8.5), 'wide_figsize': (10, 5), 'dpi': 100, 'palette_colors': 64},
+    'preview': {'tall_figsize': (8, 7), 'wide_figsize': (8, 4), 'dpi': 72, 'palette_colors': 32},
+    'full_color': {'tall_figsize': (14, 12), 'wide_figsize': (12, 6), 'dpi': 150, 'palette_colors': None}
+}
+
+# Больше столбцов на графике распределения не рисуем: стоимость рендера растет с их числом,
+# поэтому соседние значения широкого распределения объединяются в интервалы
+MAX_BARS = 80
+
+# Примерное число подписанных делений оси X
+X_TICKS = 20
+
+
+def _bin_values(values, probs, max_bars: int = MAX_BARS):
+    """ Столбцы распределения {значение: вероятность}: (левые границы, вероятности, ширина интервала).
+        Пока значений не больше max_bars, интервал - одно значение; иначе значения объединяются
+        в интервалы одинаковой целой ширины, вероятность интервала - сумма вероятностей его значений
+    """
+    values = np.asarray(values)
+    probs = np.asarray(probs, dtype=float)
+    span = int(values[-1] - values[0]) + 1
+    if span <= max_bars:
+        return values, probs, 1
+
+    width = -(-span // max_bars)
+    index = (values - values[0]) // width
+    binned = np.bincount(index, weights=probs)
+    return values[0] + np.arange(len(binned)) * width, binned, width
+
+
+def _bar_centers(edges, width: int):
+    """Середины интервалов: столбец интервала из одного значения стоит на самом значении"""
+    return edges + (width - 1) / 2
+
+
+def _set_limits(ax, x_values, y_values, bottom=None):
+    """Выставляет пределы осей с отступами как у автомасштаба matplotlib"""
+    x_min, x_max = min(x_values), max(x_values)
+    x_margin = max((x_max - x_min) * 0.05, 0.5)
+    ax.set_xlim(x_min - x_margin, x_max + x_margin)
+
+    y_min = min(y_values) if bottom is None else bottom
+    y_max = max(y_values)
+    y_margin = max((y_max - y_min) * 0.05, 1e-9)
+    ax.set_ylim(y_min - (y_margin if bottom is None else 0), y_max + y_margin)
+
+
+class _Template:
+    """ Заранее настроенная фигура: оформление осей создается один раз,
+        при рендере меняются только данные
+    """
+
+    def __init__(self, figsize, dpi, rows, cols=1, palette_colors=None, timings=None):
+        self.palette_colors = palette_colors
+        # Общий с рендерером словарь: суммарное время отрисовки и кодирования PNG
+        self.timings = timings if timings is not None else {'draw': 0.0, 'encode': 0.0}
+        self.figure = Figure(figsize=figsize, dpi=dpi)
+        self.canvas = FigureCanvasAgg(self.figure)
+        self.axes = self.figure.subplots(rows, cols, squeeze=False).ravel()
+        self.dynamic_artists = []
+
+    def add(self, *artists):
+        """Запоминает артисты, которые нужно убрать перед следующим рендером"""
+        for artist in artists:
+            if isinstance(artist, list):
+                self.dynamic_artists.extend(artist)
+            else:
+                self.dynamic_artists.append(artist)
+
+    def reset(self):
+        for artist in self.dynamic_artists:
+            artist.remove()
+        self.dynamic_artists = []
+
+    def to_png(self) -> bytes:
+        start = time.perf_counter()
+        self.canvas.draw()
+        image = Image.frombuffer('RGBA', self.canvas.get_width_height(), self.canvas.buffer_rgba())
+        self.reset()
+        drawn = time.perf_counter()
+
+        # Графики состоят из нескольких плоских цветов: палитра кодируется быстрее и весит меньше
+        image = image.convert('RGB')
+        if self.palette_colors:
+            image = image.quantize(self.palette_colors, method=Image.Quantize.FASTOCTREE)
+
+        buffer = io.BytesIO()
+        image.save(buffer, format='png')
+
+        self.timings['draw'] += drawn - start
+        self.timings['encode'] += time.perf_counter() - drawn
+        return buffer.getvalue()
+
+
+class ChartRenderer:
+    """ Рендерер графиков на объектном API matplotlib без глобального состояния pyplot.
+        Экземпляр не потокобезопасен: для каждого потока нужен свой (см. get_renderer)
+    """
+
+    def __init__(self, preset: str = 'standard'):
+        self.preset = RENDER_PRESETS[preset]
+        self.templates: Dict[str, _Template] = {}
+        # Накопленное время отрисовки и кодирования PNG; сбрасывает вызывающий код
+        self.timings = {'draw': 0.0, 'encode': 0.0}
+
+    def _template(self, name: str) -> _Template:
+        if name not in self.templates:
+            builder = {
+                'to_hit': self._build_to_hit,
+                'damage': self._build_damage,
+                'damage_vs_ac': self._build_damage_vs_ac,
+                'dashboard': self._build_dashboard
+            }[name]
+            self.templates[name] = builder()
+
+        return self.templates[name]
+
+    def _build_two_panel(self) -> _Template:
+        template = _Template(self.preset['tall_figsize'], self.preset['dpi'], rows=2,
+                             palette_colors=self.preset['palette_colors'], timings=self.timings)
+        template.figure.subplots_adjust(left=0.07, right=0.98, top=0.93, bottom=0.08, hspace=0.25)
+
+        ax1, ax2 = template.axes
+        ax1.set_ylabel('Probability (%)', fontsize=12)
+        ax2.set_ylabel('CDF (%)', fontsize=12)
+        for ax in (ax1, ax2):
+            ax.grid(True, linestyle=':', alpha=0.5)
+
+        return template
+
+    def _build_to_hit(self) -> _Template:
+        template = self._build_two_panel()
+        ax1, ax2 = template.axes
+
+        ax1.set_title('To hit distribution', pad=15, fontsize=14, fontweight='bold')
+        template.cdf_line, = ax2.plot([], [], 'g-', alpha=0.7, label='P(X ≥ x)', linewidth=1.8)
+        template.cdf_markers, = ax2.plot([], [], 'go', markersize=5)
+        ax2.legend(fontsize=10, framealpha=0.8)
+
+        return template
+
+    def _build_damage(self) -> _Template:
+        template = self._build_two_panel()
+        _, ax2 = template.axes
+
+        template.cdf_line, = ax2.plot([], [], 'r-', alpha=0.7, label='P(X ≥ x)', linewidth=1.8)
+        template.cdf_markers, = ax2.plot([], [], 'ro', markersize=4)
+        ax2.legend(fontsize=10, framealpha=0.8)
+        for ax in template.axes:
+            ax.xaxis.set_major_locator(MaxNLocator(nbins=X_TICKS, integer=True))
+            ax.tick_params(axis='x', labelsize=10)
+
+        return template
+
+    def _build_damage_vs_ac(self) -> _Template:
+        template = _Template(self.preset['wide_figsize'], self.preset['dpi'], rows=1,
+                             palette_colors=self.preset['palette_colors'], timings=self.timings)
+        template.figure.subplots_adjust(left=0.07, right=0.98, top=0.9, bottom=0.11)
+
+        ax = template.axes[0]
+        ax.set_xlabel('Armor Class (AC)', fontsize=12)
+        ax.set_ylabel('Average Damage', fontsize=12)
+        ax.set_title('Average Damage vs Armor Class', fontsize=14, fontweight='bold')
+        ax.grid(True, linestyle=':', alpha=0.7)
+        template.line, = ax.plot([], [], 'b-', linewidth=2, marker='o', markersize=4)
+
+        return template
+
+    def _build_dashboard(self) -> _Template:
+        template = _Template(self.preset['tall_figsize'], self.preset['dpi'], rows=2, cols=2,
+                             palette_colors=self.preset['palette_colors'], timings=self.timings)
+        template.figure.subplots_adjust(left=0.06, right=0.98, top=0.94, bottom=0.06, hspace=0.3, wspace=0.18)
+
+        hit_ax, normal_ax, crit_ax, ac_ax = template.axes
+        hit_ax.set_title('To hit distribution', fontsize=13, fontweight='bold')
+        ac_ax.set_title('Average Damage vs Armor Class', fontsize=13, fontweight='bold')
+        for ax in (hit_ax, normal_ax, crit_ax):
+            ax.set_ylabel('Probability (%)', fontsize=11)
+        ac_ax.set_xlabel('Armor Class (AC)', fontsize=11)
+        ac_ax.set_ylabel('Average Damage', fontsize=11)
+        for ax in template.axes:
+            ax.grid(True, linestyle=':', alpha=0.5)
+        template.line, = ac_ax.plot([], [], 'b-', linewidth=2, marker='o', markersize=4)
+
+        return template
+
+    def render_to_hit(self, dice_dist) -> bytes:
+        template = self._template('to_hit')
+        ax1, ax2 = template.axes
+
+        hit_distribution = dice_dist.to_hit_distribution
+        values = sorted(hit_distribution.keys())
+        edges, probs, width = _bin_values(values, [hit_distribution[v] * 100 for v in values])
+        centers = _bar_centers(edges, width)
+
+        # Криты стоят на отдельных позициях слева и справа от обычных значений
+        crit_miss_val = edges[0] - width
+        crit_hit_val = edges[-1] + width
+        crit_miss_prob = dice_dist.critical_miss_probability * 100
+        crit_hit_prob = dice_dist.critical_hit_probability * 100
+
+        all_values = np.concatenate(([crit_miss_val], edges, [crit_hit_val]))
+        all_probs = np.concatenate(([crit_miss_prob], probs, [crit_hit_prob]))
+        reverse_cdf = np.cumsum(all_probs[::-1])[::-1]
+
+        normal_bars = ax1.bar(centers, probs, color='blue', alpha=0.7, label='Normal values', width=0.6 * width)
+        crit_bars = ax1.bar([crit_miss_val, crit_hit_val], [crit_miss_prob, crit_hit_prob],
+                            color='red', alpha=0.7, label='Critical values', width=0.6 * width)
+        template.add(normal_bars, crit_bars, ax1.legend(fontsize=10, framealpha=0.8))
+
+        template.cdf_line.set_data(all_values, reverse_cdf)
+        template.cdf_markers.set_data(all_values, reverse_cdf)
+
+        # Пределы осей задаем сами: пересчет по всем столбцам (relim) заметно медленнее
+        _set_limits(ax1, all_values, all_probs, bottom=0)
+        _set_limits(ax2, all_values, reverse_cdf)
+
+        # Деления обычных значений выбирает MaxNLocator, подписи критов добавляются по краям
+        ticks = [tick for tick in MaxNLocator(nbins=X_TICKS, integer=True).tick_values(values[0], values[-1])
+                 if values[0] <= tick <= values[-1]]
+        x_labels = ['Crit Miss'] + [str(int(tick)) for tick in ticks] + ['Crit Hit']
+        for ax in (ax1, ax2):
+            ax.set_xticks([crit_miss_val] + ticks + [crit_hit_val])
+            ax.set_xticklabels(x_labels, fontsize=10)
+            # Подписи переиспользуются между рендерами, поэтому поворот задаем всем
+            for label in ax.get_xticklabels():
+                label.set_rotation(90 if label.get_text() in ('Crit Miss', 'Crit Hit') else 0)
+
+        return template.to_png()
+
+    def render_damage(self, dice_dist, damage_type: str = 'normal') -> bytes:
+        template = self._template('damage')
+        ax1, ax2 = template.axes
+
+        normal_dmg, crit_dmg = dice_dist.damage_distribution
+
+        if damage_type == 'normal':
+            distribution = normal_dmg
+            title = 'Non-critical damage distribution'
+        elif damage_type == 'round':
+            distribution = dice_dist.round_damage_distribution
+            title = f'Damage per round distribution (AC {dice_dist.target_ac})'
+        else:
+            distribution = crit_dmg
+            title = 'Critical damage distribution'
+
+        values = sorted(distribution.keys())
+        probs = np.array([distribution[v] * 100 for v in values])
+        mean_damage = float(np.dot(values, probs)) / 100
+
+        # P(X ≥ левой границы интервала) точна и после объединения значений
+        edges, probs, width = _bin_values(values, probs)
+        reverse_cdf = np.cumsum(probs[::-1])[::-1]
+
+        ax1.set_title(f'{title}\n(average value: {mean_damage:.1f})', pad=15, fontsize=14, fontweight='bold')
+        template.add(ax1.bar(_bar_centers(edges, width), probs, color='orange', alpha=0.7, width=0.7 * width))
+
+        template.cdf_line.set_data(edges, reverse_cdf)
+        template.cdf_markers.set_data(edges, reverse_cdf)
+
+        _set_limits(ax1, [edges[0], edges[-1] + width - 1], probs, bottom=0)
+        _set_limits(ax2, [edges[0], edges[-1] + width - 1], reverse_cdf)
+
+        return template.to_png()
+
+    def render_damage_vs_ac(self, dice_dist) -> bytes:
+        template = self._template('damage_vs_ac')
+        ax = template.axes[0]
+
+        ac_damage_dict = dice_dist.damage_vs_ac_distribution
+        ac_values = list(ac_damage_dict.keys())
+        avg_damage_values = list(ac_damage_dict.values())
+
+        template.line.set_data(ac_values, avg_damage_values)
+        _set_limits(ax, ac_values, avg_damage_values)
+        ax.set_xticks(ac_values)
+        ax.set_xticklabels([str(ac) for ac in ac_values], fontsize=10)
+
+        for ac, damage in zip(ac_values, avg_damage_values):
+            template.add(ax.annotate(f'{damage:.1f}', (ac, damage), textcoords="offset points",
+                                     xytext=(0, 5), ha='center', fontsize=8))
+
+        return template.to_png()
+
+    def render_dashboard(self, dice_dist) -> bytes:
+        """Все графики расчета на одной картинке 2x2"""
+        template = self._template('dashboard')
+        hit_ax, normal_ax, crit_ax, ac_ax = template.axes
+
+        hit_distribution = dice_dist.to_hit_distribution
+        values = sorted(hit_distribution.keys())
+        edges, probs, width = _bin_values(values, [hit_distribution[v] * 100 for v in values])
+        crit_values = [edges[0] - width, edges[-1] + width]
+        crit_probs = [dice_dist.critical_miss_probability * 100, dice_dist.critical_hit_probability * 100]
+
+        template.add(
+            hit_ax.bar(_bar_centers(edges, width), probs, color='blue', alpha=0.7, label='Normal values',
+                       width=0.6 * width),
+            hit_ax.bar(crit_values, crit_probs, color='red', alpha=0.7, label='Critical values', width=0.6 * width)
+        )
+        template.add(hit_ax.legend(fontsize=9, framealpha=0.8))
+        _set_limits(hit_ax, crit_values, list(probs) + crit_probs, bottom=0)
+
+        normal_dmg, crit_dmg = dice_dist.damage_distribution
+        for ax, distribution, title in ((normal_ax, normal_dmg, 'Non-critical damage'),
+                                        (crit_ax, crit_dmg, 'Critical damage')):
+            dmg_values = sorted(distribution.keys())
+            dmg_probs = np.array([distribution[v] * 100 for v in dmg_values])
+            mean_damage = float(np.dot(dmg_values, dmg_probs)) / 100
+            edges, dmg_probs, width = _bin_values(dmg_values, dmg_probs)
+
+            ax.set_title(f'{title} (average value: {mean_damage:.1f})', fontsize=13, fontweight='bold')
+            template.add(ax.bar(_bar_centers(edges, width), dmg_probs, color='orange', alpha=0.7, width=0.7 * width))
+            _set_limits(ax, [edges[0], edges[-1] + width - 1], dmg_probs, bottom=0)
+
+        ac_damage_dict = dice_dist.damage_vs_ac_distribution
+        ac_values = list(ac_damage_dict.keys())
+        avg_damage_values = list(ac_damage_dict.values())
+        template.line.set_data(ac_values, avg_damage_values)
+        _set_limits(ac_ax, ac_values, avg_damage_values)
+
+        return template.to_png()
+
+    def render_sweep(self, labels, ac_values, matrix) -> bytes:
+        """ Тепловая карта среднего урона: строки - варианты, столбцы - AC.
+            Форма меняется от запроса к запросу, поэтому фигура строится заново
+        """
+        width, _ = self.preset['wide_figsize']
+        figure = Figure(figsize=(width, 1.5 + 0.45 * len(labels)), dpi=self.preset['dpi'])
+        canvas = FigureCanvasAgg(figure)
+        ax = figure.subplots()
+
+        image = ax.imshow(matrix, aspect='auto', cmap='viridis')
+        figure.colorbar(image, ax=ax, label='Average Damage')
+
+        ax.set_title('Average Damage by Variant and Armor Class', fontsize=13, fontweight='bold')
+        ax.set_xlabel('Armor Class (AC)', fontsize=11)
+        ax.set_xticks(range(len(ac_values)))
+        ax.set_xticklabels([str(ac) for ac in ac_values], fontsize=9)
+        ax.set_yticks(range(len(labels)))
+        ax.set_yticklabels(labels, fontsize=9)
+
+        # Подписываем ячейки, пока их немного: текст - самая дорогая часть рендера
+        if matrix.size <= 300:
+            threshold = (matrix.max() + matrix.min()) / 2
+            for row, col in np.ndindex(matrix.shape):
+                ax.text(col, row, f'{matrix[row, col]:.1f}', ha='center', va='center', fontsize=7,
+                        color='black' if matrix[row, col] > threshold else 'white')
+
+        start = time.perf_counter()
+        figure.tight_layout()
+        canvas.draw()
+        image = Image.frombuffer('RGBA', canvas.get_width_height(), canvas.buffer_rgba()).convert('RGB')
+        drawn = time.perf_counter()
+
+        buffer = io.BytesIO()
+        image.save(buffer, format='png')
+
+        self.timings['draw'] += drawn - start
+        self.timings['encode'] += time.perf_counter() - drawn
+        return buffer.getvalue()
+
+    def render_charts(self, dice_dist, layout: str = 'separate') -> Dict[str, bytes]:
+        """ Рендерит все графики расчета: {тип графика: PNG в байтах}.
+            layout='dashboard' собирает графики урона в одну картинку
+        """
+        if layout == 'dashboard' and dice_dist.damage_roll:
+            charts = {'dashboard': self.render_dashboard(dice_dist)}
+        else:
+            charts = {'to_hit': self.render_to_hit(dice_dist)}
+
+            if dice_dist.damage_roll:
+                charts['normal_damage'] = self.render_damage(dice_dist, 'normal')
+                charts['critical_damage'] = self.render_damage(dice_dist, 'critical')
+                charts['damage_vs_ac'] = self.render_damage_vs_ac(dice_dist)
+
+        if dice_dist.damage_roll and dice_dist.has_round:
+            charts['round_damage'] = self.render_damage(dice_dist, 'round')
+
+        return charts
+
+
+_local = threading.local()
+
+
+def get_renderer(preset: str = 'standard') -> ChartRenderer:
+    """Возвращает рендерер текущего потока для пресета, создавая его при первом вызове"""
+    renderers = getattr(_local, 'renderers', None)
+    if renderers is None:
+        renderers = _local.renderers = {}
+
+    if preset not in renderers:
+        renderers[preset] = ChartRenderer(preset)
+
+    return renderers[preset]
@@ -12,3 +12,78 @@ BOT_CONFIG = {
     'parse_mode': 'HTML',
     'disable_web_page_preview': True
 }
+
+# Общий кэш результатов расчета: готовые PNG графиков или текстовая сводка; max_bytes - по их размеру
+RESULT_CACHE_CONFIG = {
+    'max_entries': int(os.getenv('RESULT_CACHE_MAX_ENTRIES', 512)),
+    'max_bytes': int(os.getenv('RESULT_CACHE_MAX_BYTES', 256 * 1024 * 1024))
+}
+
+# Локальное хранилище file_id загруженных в Telegram графиков: file_id последних
+# FILE_ID_STORE_MAX_ENTRIES расчетов, давно не использованные вытесняются
+FILE_ID_STORE_PATH = os.getenv('FILE_ID_STORE_PATH', 'file_ids.sqlite3')
+FILE_ID_STORE_MAX_ENTRIES = int(os.getenv('FILE_ID_STORE_MAX_ENTRIES', 10000))
+
+# Пул процессов для расчетов и рендера графиков
+RENDER_POOL_CONFIG = {
+    'workers': int(os.getenv('RENDER_WORKERS', 2)),
+    'max_queue': int(os.getenv('RENDER_QUEUE_DEPTH', 16)),
+    # renderer: 'fast' (объектный API matplotlib) или 'pyplot'; preset - см. chart_renderer.RENDER_PRESETS
+    'render_options': {
+        'renderer': os.getenv('CHART_RENDERER', 'fast'),
+        'preset': os.getenv('CHART_PRESET', 'telegram')
+    }
+}
+
+# Метрики: локальный эндпоинт Prometheus (порт 0 - выключен) и админы с доступом к /metrics
+METRICS_CONFIG = {
+    'host': os.getenv('METRICS_HOST', '127.0.0.1'),
+    'port': int(os.getenv('METRICS_PORT', 9108))
+}
+
+ADMIN_USER_IDS = {
+    int(user_id) for user_id in os.getenv('ADMIN_USER_IDS', '').split(',') if user_id.strip()
+}
+
+
+# Прием обновлений: 'polling' (long polling) или 'webhook' (локальный HTTP-сервер, см. webhook_server.py)
+BOT_MODE = os.getenv('BOT_MODE', 'polling')
+
+# url - публичный адрес, который регистрируется в Telegram; пустой - сервер только слушает (локальная проверка).
+# max_queue - обновлений в очереди, сверх нее сервер отвечает 503; workers - одновременно обрабатываемых обновлений
+WEBHOOK_CONFIG = {
+    'host': os.getenv('WEBHOOK_HOST', '127.0.0.1'),
+    'port': int(os.getenv('WEBHOOK_PORT', 8443)),
+    'path': os.getenv('WEBHOOK_PATH', '/webhook'),
+    'url': os.getenv('WEBHOOK_URL', ''),
+    'secret_token': os.getenv('WEBHOOK_SECRET', ''),
+    'max_queue': int(os.getenv('WEBHOOK_QUEUE_DEPTH', 256)),
+    'workers': int(os.getenv('WEBHOOK_WORKERS', 16))
+}
+
+# Кнопка расчета: rate - запросов в секунду на пользователя, burst - подряд без ожидания,
+# max_concurrent - одновременно выполняемых расчетов на весь бот
+CALCULATE_LIMIT_CONFIG = {
+    'rate': float(os.getenv('CALCULATE_RATE', 0.5)),
+    'burst': int(os.getenv('CALCULATE_BURST', 3)),
+    'max_concurrent': int(os.getenv('CALCULATE_MAX_CONCURRENT', 32))
+}
+
+# Сессии: session_timeout - секунд без действий до удаления, cleanup_interval - период проверки,
+# max_sessions - предел памяти под сессии: сверх него вытесняются давно не использованные
+SESSION_CONFIG = {
+    'session_timeout': int(os.getenv('SESSION_TIMEOUT', 1800)),
+    'cleanup_interval': float(os.getenv('SESSION_CLEANUP_INTERVAL', 5)),
+    'max_sessions': int(os.getenv('SESSION_MAX_COUNT', 100000))
+}
+
+# Хранилище сессий (см. session_backends.py): 'memory', 'sqlite' или 'redis' (нужен пакет redis).
+# flush_interval - период пакетной записи изменений в секундах; shared - файл SQLite общий
+# для нескольких процессов бота: сессии читаются и пишутся сразу, без копии в памяти (Redis - всегда)
+SESSION_BACKEND_CONFIG = {
+    'backend': os.getenv('SESSION_BACKEND', 'memory'),
+    'path': os.getenv('SESSION_DB_PATH', 'sessions.sqlite3'),
+    'url': os.getenv('SESSION_REDIS_URL', 'redis://localhost:6379/0'),
+    'flush_interval': float(os.getenv('SESSION_FLUSH_INTERVAL', 1.0)),
+    'shared': os.getenv('SESSION_SHARED', '0') == '1'
+}
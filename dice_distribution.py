@@ -1,59 +1,162 @@
-import re
 import io
+import itertools
 from collections import defaultdict
-import json
-from typing import Dict, Tuple, List
+from functools import cached_property
+from typing import Dict, List, Tuple
 
-import matplotlib
-matplotlib.use('Agg')
-import matplotlib.pyplot as plt
 import numpy as np
 
+from dice_engine import (Distribution, convolve, dice_sum_distribution, distribution_to_dict,
+                         spectrum, spectrum_to_distribution)
+from dice_notation import parse_dice_notation, split_flat_modifier
+from params import ADVANTAGE_TYPES, MAX_ROUND_VALUES
 
-def parse_dice_notation(notation: str) -> Tuple[List, int]:
-    """ Функция принимает строку с нотацией дайс ролла
-        и возвращает распаршенную строку со значениями дайсов
-        и суммой абсолютных модификаторов
+
+def _pyplot():
+    """ pyplot импортируется только при рендере через plot_* методы:
+        расчеты и текстовый режим обходятся без matplotlib
     """
-    if not notation or not notation.strip():
-        return [], 0
+    import matplotlib
+    matplotlib.use('Agg')
+    import matplotlib.pyplot as plt
 
-    clean_notation = notation.replace(' ', '').replace('к', 'd').replace('К', 'd').replace('D', 'd').lower()
+    return plt
 
-    dice = []
-    flat = 0
 
-    for token in re.findall(r'([+-]?\d*d\d+|[-+]?\d+)', clean_notation.replace(' ', '')):
-        if 'd' in token:
-            # Обрабатываем знак
-            sign = -1 if token.startswith('-') else 1
-            clean_token = token.lstrip('+-')
+def _d20_table(advantage_status: int, halfling_luck_active: bool) -> np.ndarray:
+    """ Считает вероятности граней 1..20 итогового d20 перебором всех исходов.
+        Halfling's Luck перебрасывает один куб с единицей; если единицы на всех кубах,
+        результат определяет переброшенный куб
+    """
+    dice_count = 1 + abs(advantage_status)
+    pick = np.min if advantage_status < 0 else np.max
 
-            # Парсим количество дайсов и значение
-            count_str, faces_str = clean_token.split('d')
-            count = int(count_str) if count_str else 1
-            faces = int(faces_str)
+    rolls = np.array(list(itertools.product(range(1, 21), repeat=dice_count)))
+    weight = 1 / len(rolls)
+    table = np.zeros(21)
 
-            # Добавляем кубы с учетом знака
-            dice.extend([sign * faces] * count)
-        else:
-            flat += int(token)
+    if not halfling_luck_active:
+        np.add.at(table, pick(rolls, axis=1), weight)
+    else:
+        has_one = (rolls == 1).any(axis=1)
+        np.add.at(table, pick(rolls[~has_one], axis=1), weight)
+
+        lucky_rolls = rolls[has_one]
+        rerolled_index = np.argmax(lucky_rolls == 1, axis=1)
+        all_ones = (lucky_rolls == 1).all(axis=1)
+
+        for new_face in range(1, 21):
+            rerolled = lucky_rolls.copy()
+            rerolled[np.arange(len(rerolled)), rerolled_index] = new_face
+            result = pick(rerolled, axis=1)
+            result[all_ones] = new_face
+            np.add.at(table, result, weight / 20)
 
-    return dice, flat
+    table = table[1:]
+    table.setflags(write=False)
+    return table
+
+
+# Таблицы d20 считаются один раз при импорте: (advantage_status, halfling_luck_active) -> probs[грань - 1]
+D20_DISTRIBUTIONS = {
+    (advantage_status, halfling_luck_active): _d20_table(advantage_status, halfling_luck_active)
+    for advantage_status in ADVANTAGE_TYPES
+    for halfling_luck_active in (False, True)
+}
 
 
 def calculate_d20_distribution(advantage_status: int = 0,
                                halfling_luck_active: bool = False) -> Dict[int, float]:
 
-    with open('d20_distributions.json', 'r', encoding='utf-8') as file:
-        data = json.load(file)
+    table = D20_DISTRIBUTIONS[(advantage_status, bool(halfling_luck_active))]
+
+    return {face: float(prob) for face, prob in enumerate(table, start=1)}
+
+
+def _distribution_stats(distribution: Dict[int, float], quantiles) -> tuple:
+    """Среднее и квантили распределения {значение: вероятность}"""
+    values = np.array(sorted(distribution.keys()))
+    probs = np.array([distribution[v] for v in values])
+    cdf = np.cumsum(probs)
+
+    mean = float(np.dot(values, probs))
+    # Небольшой допуск, чтобы ошибки округления не сдвигали квантиль на соседнее значение
+    indices = np.searchsorted(cdf, np.array(quantiles) - 1e-12)
+
+    return (mean, *(int(values[min(i, len(values) - 1)]) for i in indices))
+
+
+def _rider_distributions(notation: str) -> Tuple[Distribution, Distribution]:
+    """Обычный и критический доп. урон по нотации: на крите кубы удваиваются, модификаторы - нет"""
+    dice, flat = parse_dice_notation(notation)
+    normal_offset, normal_probs = dice_sum_distribution(dice)
+    crit_offset, crit_probs = convolve((normal_offset, normal_probs), (normal_offset, normal_probs))
+
+    return (normal_offset + flat, normal_probs), (crit_offset + flat, crit_probs)
+
+
+def _mean(distribution: Distribution) -> float:
+    offset, probs = distribution
+    return float(np.dot(np.arange(offset, offset + len(probs)), probs))
+
 
-    params = f'({advantage_status}, {halfling_luck_active})'
+def _rider_means(notation: str) -> Tuple[float, float]:
+    """Средний обычный и критический доп. урон: без свертки удвоенных кубов"""
+    dice, flat = parse_dice_notation(notation)
+    avg_dice = _mean(dice_sum_distribution(dice))
 
-    return {int(k): float(v) for k, v in data[params].items()}
+    return avg_dice + flat, 2 * avg_dice + flat
+
+
+def _is_active_notation(notation: str) -> bool:
+    """Нотация дает ненулевой бросок (пустая строка и '0' - доп. урона нет)"""
+    dice, flat = parse_dice_notation(notation)
+    return bool(dice) or flat != 0
+
+
+# Ширина диапазона AC по умолчанию: графики и таблица подписывают каждый AC, поэтому
+# большие модификаторы попадания не должны давать сотни значений (при min_ac=8 - AC 8..30)
+AC_DISPLAY_WINDOW = 23
+
+# Строк AC в текстовой сводке: сообщение Telegram не длиннее 4096 символов
+TEXT_AC_ROWS = 23
 
 
 class DiceDistribution:
+    # Изменение любого из входных параметров сбрасывает закэшированные результаты
+    INPUT_ATTRIBUTES = (
+        'to_hit_roll',
+        'damage_roll',
+        'crit_hit_number',
+        'advantage_status',
+        'great_weapon_fighting_active',
+        'halfling_luck_active',
+        'attacks_per_round',
+        'per_hit_rider',
+        'once_per_turn_rider',
+        'target_ac',
+        'min_ac',
+        'max_ac'
+    )
+
+    CACHED_ATTRIBUTES = (
+        '_to_hit_notation',
+        '_damage_notation',
+        '_per_hit_rider_notation',
+        '_to_hit_modifiers',
+        '_to_hit_array',
+        '_hit_survival',
+        '_damage_dice_distribution',
+        '_average_damage',
+        'd20_distribution',
+        'critical_miss_probability',
+        'critical_hit_probability',
+        'to_hit_distribution',
+        'damage_distribution',
+        'damage_vs_ac_distribution',
+        'round_damage_distribution',
+        'round_damage_vs_ac_distribution'
+    )
 
     def __init__(self,
                  to_hit_roll,
@@ -61,7 +164,13 @@ class DiceDistribution:
                  crit_hit_number=20,
                  advantage_status=0,
                  great_weapon_fighting_active=False,
-                 halfling_luck_active=False):
+                 halfling_luck_active=False,
+                 attacks_per_round=1,
+                 per_hit_rider='',
+                 once_per_turn_rider='',
+                 target_ac=15,
+                 min_ac=8,
+                 max_ac=None):
 
         self.to_hit_roll = to_hit_roll.strip()
         self.damage_roll = damage_roll.strip()
@@ -69,138 +178,196 @@ class DiceDistribution:
         self.advantage_status = advantage_status
         self.great_weapon_fighting_active = great_weapon_fighting_active
         self.halfling_luck_active = halfling_luck_active
-
-        self.d20_distribution = calculate_d20_distribution(self.advantage_status)
-        self.critical_miss_probability = self.d20_distribution[1]
-
-        self.d20_dice_modifiers, self.d20_flat_modifiers = parse_dice_notation(self.to_hit_roll)
-        self.damage_dice_modifiers, self.damage_flat_modifiers = parse_dice_notation(self.damage_roll)
+        # Раунд: число одинаковых атак, доп. урон за каждое попадание (Hunter's Mark)
+        # и раз в ход на первое попадание (Sneak Attack); target_ac - AC для распределения урона за раунд
+        self.attacks_per_round = attacks_per_round
+        self.per_hit_rider = per_hit_rider.strip()
+        self.once_per_turn_rider = once_per_turn_rider.strip()
+        self.target_ac = target_ac
+        # Диапазон AC для damage_vs_ac_distribution; max_ac=None - пока попадают не только криты
+        self.min_ac = min_ac
+        self.max_ac = max_ac
+
+    def __setattr__(self, name, value):
+        super().__setattr__(name, value)
+        if name in self.INPUT_ATTRIBUTES:
+            self.invalidate()
+
+    def invalidate(self):
+        """Сбрасывает все закэшированные результаты расчета"""
+        for name in self.CACHED_ATTRIBUTES:
+            self.__dict__.pop(name, None)
+
+    @cached_property
+    def _to_hit_notation(self):
+        return parse_dice_notation(self.to_hit_roll)
+
+    @cached_property
+    def _damage_notation(self):
+        return parse_dice_notation(self.damage_roll)
+
+    @cached_property
+    def _per_hit_rider_notation(self):
+        return parse_dice_notation(self.per_hit_rider)
 
     @property
-    def critical_hit_probability(self):
-        d20_probs = np.array(list(self.d20_distribution.values()))
-        crit_mask = np.arange(1, 21) >= self.crit_hit_number
-        return np.sum(d20_probs[crit_mask])
+    def d20_dice_modifiers(self):
+        return self._to_hit_notation[0]
 
-    def to_hit_modifiers_distribution(self):
-        dice_list, flat_modifiers = self.d20_dice_modifiers, self.d20_flat_modifiers
-
-        # Учитываем отрицательные значения в кубиках
-        min_sum = sum(d for d in dice_list if d < 0)
-        max_sum = sum(d for d in dice_list if d > 0)
+    @property
+    def d20_flat_modifiers(self):
+        return self._to_hit_notation[1]
 
-        # Создаем массив вероятностей, охватывающий все возможные суммы
-        prob_array = np.zeros(max_sum - min_sum + 1)
-        prob_array[-min_sum] = 1.0  # Смещаем нулевую точку
+    @property
+    def damage_dice_modifiers(self):
+        return self._damage_notation[0]
 
-        for dice in dice_list:
-            new_prob = np.zeros_like(prob_array)
-            dice_abs = abs(dice)
-            sign = 1 if dice > 0 else -1
+    @property
+    def damage_flat_modifiers(self):
+        return self._damage_notation[1] + self._per_hit_rider_notation[1]
 
-            for val in np.where(prob_array > 0)[0]:
-                p = prob_array[val]
-                current_sum = val + min_sum  # Переводим в реальную сумму
-                # Генерируем все возможные значения для текущего кубика
-                for face in range(1, dice_abs + 1):
-                    new_val = current_sum + sign * face - min_sum  # Переводим обратно в индекс
-                    new_prob[new_val] += p * (1 / dice_abs)
-            prob_array = new_prob
+    @property
+    def has_round(self):
+        """Урон за раунд отличается от урона одной атаки"""
+        return self.attacks_per_round > 1 or _is_active_notation(self.once_per_turn_rider)
 
-        return {k + min_sum + flat_modifiers: v for k, v in enumerate(prob_array) if v > 0}
+    @cached_property
+    def d20_distribution(self):
+        return calculate_d20_distribution(self.advantage_status, self.halfling_luck_active)
 
-    @property
-    def to_hit_distribution(self):
-        d20 = self.d20_distribution
-        modifiers = self.to_hit_modifiers_distribution()
+    @cached_property
+    def critical_miss_probability(self):
+        return self.d20_distribution[1]
 
-        prob_master = defaultdict(float)
+    @cached_property
+    def critical_hit_probability(self):
+        d20_probs = D20_DISTRIBUTIONS[(self.advantage_status, bool(self.halfling_luck_active))]
+        return float(np.sum(d20_probs[self.crit_hit_number - 1:]))
 
-        for val_d20, prob_d20 in d20.items():
-            if val_d20 == 1 or val_d20 in range(self.crit_hit_number, 21):
-                pass
-            else:
-                for val_modifiers, prob_modifiers in modifiers.items():
-                    prob_master[val_d20 + val_modifiers] += prob_d20 * prob_modifiers
+    @cached_property
+    def _to_hit_modifiers(self):
+        distribution = dice_sum_distribution(self.d20_dice_modifiers)
 
-        return prob_master
+        return distribution_to_dict(distribution, self.d20_flat_modifiers)
 
-    @property
-    def damage_distribution(self):
-        dice_list, flat_modifiers = self.damage_dice_modifiers, self.damage_flat_modifiers
+    def to_hit_modifiers_distribution(self):
+        return self._to_hit_modifiers
 
-        def calculate_distribution(dice_list):
-            prob_master = defaultdict(float)
-            prob_master[0] = 1.0
+    @cached_property
+    def _to_hit_array(self):
+        """ Плотное распределение суммы d20 и модификаторов без критов: (offset, probs).
+            Грань 1 и грани от crit_hit_number обнулены - это автопромах и автопопадание
+        """
+        d20_probs = D20_DISTRIBUTIONS[(self.advantage_status, bool(self.halfling_luck_active))].copy()
+        d20_probs[0] = 0
+        d20_probs[self.crit_hit_number - 1:] = 0
 
-            for dice in dice_list:
-                new_prob_master = defaultdict(float)
+        modifiers_offset, modifiers_probs = dice_sum_distribution(self.d20_dice_modifiers)
 
-                for current_sum, current_prob in prob_master.items():
-                    if self.great_weapon_fighting_active:
-                        # Создаем распределение для одного кубика с GWF
-                        single_die_probs = defaultdict(float)
+        return convolve((1, d20_probs), (modifiers_offset + self.d20_flat_modifiers, modifiers_probs))
 
-                        # Стандартные броски
-                        for face in range(3, dice + 1):
-                            single_die_probs[face] += 1 / dice
+    @cached_property
+    def _hit_survival(self):
+        """P(итог >= offset + i) для обычных попаданий: обратная накопленная сумма"""
+        offset, probs = self._to_hit_array
+        # Ноль в конце - значение для AC выше любого некритического броска
+        return offset, np.append(np.cumsum(probs[::-1])[::-1], 0.0)
 
-                        # Броски с перебросом (1 и 2)
-                        for _ in [1, 2]:
-                            p_initial = 1 / dice
+    @cached_property
+    def to_hit_distribution(self):
+        return defaultdict(float, distribution_to_dict(self._to_hit_array))
 
-                            for reroll_face in range(1, dice + 1):
-                                single_die_probs[reroll_face] += p_initial * (1 / dice)
+    def normal_hit_probabilities(self, ac_values) -> np.ndarray:
+        """Вероятности некритического попадания для массива AC: одна выборка на AC"""
+        offset, survival = self._hit_survival
+        indices = np.clip(np.asarray(ac_values) - offset, 0, len(survival) - 1)
+        return survival[indices]
 
-                        for face, face_prob in single_die_probs.items():
-                            new_prob_master[current_sum + face] += current_prob * face_prob
-                    else:
-                        # Обычный бросок без GWF
-                        for face in range(1, dice + 1):
-                            new_prob_master[current_sum + face] += current_prob * (1 / dice)
+    def hit_probabilities(self, ac_values) -> np.ndarray:
+        """Вероятности попадания для массива AC с учетом автоматических попаданий на крите"""
+        return self.normal_hit_probabilities(ac_values) + self.critical_hit_probability
 
-                prob_master = new_prob_master
+    def hit_probability(self, ac):
+        """Вероятность попасть по AC с учетом автоматических попаданий на крите"""
+        return float(self.hit_probabilities([ac])[0])
 
-            return prob_master
+    def expected_damage(self, ac_values) -> np.ndarray:
+        """Средний урон за атаку для массива AC, любой диапазон без доп. затрат на AC"""
+        avg_normal_dmg, avg_crit_dmg = self._average_damage
+        return (avg_normal_dmg * self.normal_hit_probabilities(ac_values)
+                + avg_crit_dmg * self.critical_hit_probability)
 
-        normal_dist = calculate_distribution(dice_list)
-        crit_dist = calculate_distribution(dice_list * 2)
+    @property
+    def ac_values(self):
+        """ Диапазон AC по умолчанию: до AC, по которому попадают только криты, но не шире AC_DISPLAY_WINDOW.
+            Явный max_ac задает любой диапазон
+        """
+        max_ac = self.max_ac
+        if max_ac is None:
+            max_ac = max(max(self.to_hit_modifiers_distribution()) + 22, self.min_ac)
+            max_ac = min(max_ac, self.min_ac + AC_DISPLAY_WINDOW - 1)
+
+        return range(self.min_ac, max_ac + 1)
+
+    @cached_property
+    def _damage_dice_distribution(self):
+        weapon_dice = dice_sum_distribution(self.damage_dice_modifiers, self.great_weapon_fighting_active)
+        # Great Weapon Fighting не действует на кубы доп. урона за попадание
+        return convolve(weapon_dice, dice_sum_distribution(self._per_hit_rider_notation[0]))
+
+    @cached_property
+    def damage_distribution(self):
+        normal_dist = self._damage_dice_distribution
+        # При крите кубы удваиваются: сумма двух независимых наборов тех же кубов
+        crit_dist = convolve(normal_dist, normal_dist)
 
-        normal_dist = {k + flat_modifiers: v for k, v in normal_dist.items()}
-        crit_dist = {k + flat_modifiers: v for k, v in crit_dist.items()}
+        normal_dist = distribution_to_dict(normal_dist, self.damage_flat_modifiers)
+        crit_dist = distribution_to_dict(crit_dist, self.damage_flat_modifiers)
 
         return normal_dist, crit_dist
 
-    @property
-    def damage_vs_ac_distribution(self):
-        normal_dmg_dist, crit_dmg_dist = self.damage_distribution
+    @cached_property
+    def _average_damage(self):
+        """Средний урон обычного и критического попадания"""
+        offset, probs = self._damage_dice_distribution
+        avg_dice = _mean((offset, probs))
+        # Кубы при крите удваиваются, модификаторы - нет
+        return avg_dice + self.damage_flat_modifiers, 2 * avg_dice + self.damage_flat_modifiers
 
-        avg_normal_dmg = sum(val * prob for val, prob in normal_dmg_dist.items())
-        avg_crit_dmg = sum(val * prob for val, prob in crit_dmg_dist.items())
+    @cached_property
+    def damage_vs_ac_distribution(self):
+        ac_values = self.ac_values
+        expected_damage = self.expected_damage(ac_values)
 
-        critical_hit_probability = self.critical_hit_probability
+        return {ac: float(damage) for ac, damage in zip(ac_values, expected_damage)}
 
-        to_hit_distribution = self.to_hit_distribution
+    def round_damage_distributions(self, ac_values) -> Distribution:
+        """Распределения урона за раунд из attacks_per_round одинаковых атак для массива AC"""
+        return round_damage_distributions([self] * self.attacks_per_round, ac_values, self.once_per_turn_rider)
 
-        dmg_vs_ac_distribution = {}
+    @cached_property
+    def round_damage_distribution(self):
+        """Распределение урона за раунд по target_ac, включая нулевой урон при промахах"""
+        offset, probs = self.round_damage_distributions([self.target_ac])
+        return distribution_to_dict((offset, probs[0]))
 
-        max_to_hit_value = min(
-            sum(self.d20_dice_modifiers) + self.d20_flat_modifiers + 23,
-            31
-        )
+    @cached_property
+    def round_damage_vs_ac_distribution(self):
+        ac_values = self.ac_values
+        expected_damage = round_expected_damage([self] * self.attacks_per_round, ac_values, self.once_per_turn_rider)
 
-        for ac in range(8, max_to_hit_value):
-            expected_damage = sum(
-                avg_normal_dmg * prob
-                for val, prob in to_hit_distribution.items()
-                if val >= ac
-            ) + avg_crit_dmg * critical_hit_probability
+        return {ac: float(damage) for ac, damage in zip(ac_values, expected_damage)}
 
-            dmg_vs_ac_distribution[ac] = expected_damage
+    def sample(self, samples=None, seed=0, **kwargs):
+        """ Эмпирические распределения тех же параметров методом Монте-Карло (см. dice_sampler).
+            Нужно для механик без точной формулы и для сверки точного расчета
+        """
+        from dice_sampler import DEFAULT_SAMPLES, SampledDistribution
 
-        return dmg_vs_ac_distribution
+        return SampledDistribution(self, samples=samples or DEFAULT_SAMPLES, seed=seed, **kwargs)
 
     def plot_to_hit_distribution(self, save_path=None):
+        plt = _pyplot()
         hit_distribution = self.to_hit_distribution
 
         # Подготовка данных
@@ -263,11 +430,15 @@ class DiceDistribution:
         return img_buffer
 
     def plot_damage_distribution(self, damage_type='normal', save_path=None):
+        plt = _pyplot()
         normal_dmg, crit_dmg = self.damage_distribution
 
         if damage_type == 'normal':
             distribution = normal_dmg
             title = 'Non-critical damage distribution'
+        elif damage_type == 'round':
+            distribution = self.round_damage_distribution
+            title = f'Damage per round distribution (AC {self.target_ac})'
         else:
             distribution = crit_dmg
             title = 'Critical damage distribution'
@@ -320,6 +491,7 @@ class DiceDistribution:
         return img_buffer
 
     def plot_average_damage_vs_ac(self, save_path=None):
+        plt = _pyplot()
         ac_damage_dict = self.damage_vs_ac_distribution
         ac_values = list(ac_damage_dict.keys())
         avg_damage_values = list(ac_damage_dict.values())
@@ -345,6 +517,241 @@ class DiceDistribution:
 
         return img_buffer
 
+    def text_ac_values(self):
+        """AC для таблицы текстовой сводки: не больше TEXT_AC_ROWS подряд, по возможности вокруг target_ac"""
+        ac_values = list(self.ac_values)
+        if len(ac_values) <= TEXT_AC_ROWS:
+            return ac_values
+
+        center = min(max(self.target_ac - ac_values[0], 0), len(ac_values) - 1)
+        start = min(max(center - TEXT_AC_ROWS // 2, 0), len(ac_values) - TEXT_AC_ROWS)
+        return ac_values[start:start + TEXT_AC_ROWS]
+
+    def text_summary(self):
+        """ Короткая HTML-сводка расчета без графиков: шанс попадания и средний урон по AC,
+            шансы критов и статистика урона. matplotlib не используется.
+            Таблица по AC ограничена окном text_ac_values, чтобы сводка помещалась в одно сообщение
+        """
+        crit_chance = self.critical_hit_probability * 100
+        lines = [
+            f'🎯 <b>To-Hit:</b> <code>{self.to_hit_roll}</code>',
+            f'💥 Крит: <b>{crit_chance:.1f}%</b>   💀 Крит. промах: <b>{self.critical_miss_probability * 100:.1f}%</b>'
+        ]
+
+        ac_values = self.text_ac_values()
+        hit_chances = self.hit_probabilities(ac_values) * 100
+
+        if self.damage_roll:
+            normal_dmg, crit_dmg = self.damage_distribution
+            lines.append('')
+            lines.append(f'🩸 <b>Урон:</b> <code>{self.damage_roll}</code>')
+            lines.append('<pre>')
+            lines.append(f'{"":8}{"Средн":>7}{"Мед":>6}{"P10":>6}{"P90":>6}')
+            for name, distribution in (('Обычный', normal_dmg), ('Крит', crit_dmg)):
+                mean, p10, median, p90 = _distribution_stats(distribution, (0.1, 0.5, 0.9))
+                lines.append(f'{name:8}{mean:7.1f}{median:6d}{p10:6d}{p90:6d}')
+            lines.append('</pre>')
+
+            lines.append('⚔️🛡️ <b>По AC:</b>')
+            lines.append('<pre>')
+            if self.has_round:
+                lines.append(f'{"AC":>3}{"Попад.":>9}{"Урон":>8}{"Раунд":>8}')
+                for ac, hit_chance in zip(ac_values, hit_chances):
+                    lines.append(f'{ac:3d}{hit_chance:8.1f}%{self.damage_vs_ac_distribution[ac]:8.1f}'
+                                 f'{self.round_damage_vs_ac_distribution[ac]:8.1f}')
+            else:
+                lines.append(f'{"AC":>3}{"Попад.":>9}{"Урон":>8}')
+                for ac, hit_chance in zip(ac_values, hit_chances):
+                    lines.append(f'{ac:3d}{hit_chance:8.1f}%{self.damage_vs_ac_distribution[ac]:8.1f}')
+            lines.append('</pre>')
+
+            if self.has_round:
+                round_dmg = self.round_damage_distribution
+                mean, p10, median, p90 = _distribution_stats(round_dmg, (0.1, 0.5, 0.9))
+                lines.append(f'⚔️⚔️ <b>За раунд по AC {self.target_ac}</b> '
+                             f'({self.attacks_per_round} атак.): средний <b>{mean:.1f}</b>, '
+                             f'медиана {median}, P10 {p10}, P90 {p90}, '
+                             f'без урона {round_dmg.get(0, 0.0) * 100:.1f}%')
+        else:
+            lines.append('')
+            lines.append('🛡️ <b>Шанс попадания по AC:</b>')
+            lines.append('<pre>')
+            lines.append(f'{"AC":>3}{"Попад.":>9}')
+            for ac, hit_chance in zip(ac_values, hit_chances):
+                lines.append(f'{ac:3d}{hit_chance:8.1f}%')
+            lines.append('</pre>')
+
+        return '\n'.join(lines)
+
+    def render_charts(self, renderer='fast', preset='standard', layout='separate'):
+        """ Рендерит все графики расчета: {тип графика: PNG в байтах}.
+            renderer='fast' - объектный рендерер chart_renderer с пресетом preset,
+            renderer='pyplot' - методы plot_* через pyplot.
+            layout='dashboard' (только объектный рендерер) - все графики на одной картинке
+        """
+        if renderer == 'fast' or layout == 'dashboard':
+            from chart_renderer import get_renderer
+
+            return get_renderer(preset).render_charts(self, layout)
+
+        charts = {'to_hit': self.plot_to_hit_distribution().getvalue()}
+
+        if self.damage_roll:
+            charts['normal_damage'] = self.plot_damage_distribution('normal').getvalue()
+            charts['critical_damage'] = self.plot_damage_distribution('critical').getvalue()
+            charts['damage_vs_ac'] = self.plot_average_damage_vs_ac().getvalue()
+
+            if self.has_round:
+                charts['round_damage'] = self.plot_damage_distribution('round').getvalue()
+
+        return charts
+
+
+def round_expected_damage(attacks: List[DiceDistribution], ac_values, once_per_turn_rider: str = '') -> np.ndarray:
+    """ Средний урон за раунд для массива AC без построения распределений: сумма средних атак
+        и доп. урон раз в ход, умноженный на вероятность, что это первое попадание раунда:
+        sum P(до атаки i попаданий не было) * (p_hit_i * E[доп. урон] + p_crit_i * E[крит. доп. урон])
+    """
+    ac_values = np.asarray(ac_values)
+    expected = np.zeros(len(ac_values))
+    for attack in attacks:
+        expected += attack.expected_damage(ac_values)
+
+    if _is_active_notation(once_per_turn_rider):
+        avg_rider, avg_crit_rider = _rider_means(once_per_turn_rider)
+        no_hit = np.ones(len(ac_values))
+        for attack in attacks:
+            normal_hit = attack.normal_hit_probabilities(ac_values)
+            crit_hit = attack.critical_hit_probability
+            expected += no_hit * (normal_hit * avg_rider + crit_hit * avg_crit_rider)
+            no_hit = no_hit * (1 - normal_hit - crit_hit)
+
+    return expected
+
+
+def round_damage_distributions(attacks: List[DiceDistribution], ac_values,
+                               once_per_turn_rider: str = '') -> Distribution:
+    """ Точное распределение суммарного урона за раунд для каждого AC: (offset, probs[AC, урон]).
+        Атака - смесь промаха, обычного попадания и крита, атаки независимы, поэтому спектр
+        раунда - произведение спектров атак; все AC считаются одним батчем.
+        Память - len(ac_values) спектров, поэтому распределения строятся только для нужных AC
+        (средний урон по всем AC дает round_expected_damage); больше MAX_ROUND_VALUES значений - ValueError
+        (бот отклоняет такие параметры заранее, см. params.calculation_budget_error).
+        once_per_turn_rider (Sneak Attack) добавляется к первому попаданию раунда
+    """
+    ac_values = np.asarray(ac_values)
+
+    components = {}
+    for attack in attacks:
+        if id(attack) not in components:
+            dice = attack._damage_dice_distribution
+            crit = convolve(dice, dice)
+            flat = attack.damage_flat_modifiers
+            components[id(attack)] = (dice[0] + flat, dice[1]), (crit[0] + flat, crit[1])
+
+    rider = _rider_distributions(once_per_turn_rider) if _is_active_notation(once_per_turn_rider) else None
+
+    # Диапазон суммы известен заранее: каждое слагаемое дает от min(0, ...) до max(0, ...)
+    terms = [components[id(attack)] for attack in attacks] + ([rider] if rider else [])
+    min_value = sum(min(0, normal[0], crit[0]) for normal, crit in terms)
+    max_value = sum(max(0, normal[0] + len(normal[1]) - 1, crit[0] + len(crit[1]) - 1) for normal, crit in terms)
+    size = max_value - min_value + 1
+    fft_size = 1 << (size - 1).bit_length()
+    if size > MAX_ROUND_VALUES:
+        raise ValueError(f'Слишком широкое распределение урона за раунд: {size} значений')
+
+    spectra = {
+        key: (spectrum(normal, fft_size), spectrum(crit, fft_size))
+        for key, (normal, crit) in components.items()
+    }
+
+    round_spectra = np.ones((len(ac_values), fft_size // 2 + 1), dtype=complex)
+    # Вероятность, что попаданий в раунде еще не было
+    no_hit = np.ones(len(ac_values))
+    if rider:
+        rider_normal, rider_crit = spectrum(rider[0], fft_size), spectrum(rider[1], fft_size)
+        round_spectra[:] = 0
+
+    for attack in attacks:
+        normal_spectrum, crit_spectrum = spectra[id(attack)]
+        normal_hit = attack.normal_hit_probabilities(ac_values)[:, None]
+        crit_hit = attack.critical_hit_probability
+        normal_part = normal_hit * normal_spectrum
+        crit_part = crit_hit * crit_spectrum
+        miss = 1 - normal_hit - crit_hit
+
+        if rider is None:
+            round_spectra *= miss + normal_part + crit_part
+        else:
+            # round_spectra - ветка "уже было попадание": доп. урон раз в ход уже нанесен
+            round_spectra = (round_spectra * (miss + normal_part + crit_part)
+                             + no_hit[:, None] * (normal_part * rider_normal + crit_part * rider_crit))
+            no_hit = no_hit * miss[:, 0]
+
+    if rider:
+        round_spectra += no_hit[:, None]
+
+    return spectrum_to_distribution(round_spectra, fft_size, min_value, size)
+
+
+# Сдвиги плоских модификаторов в вариантах сравнения
+SWEEP_BONUS_KEYS = ('to_hit_bonus', 'damage_bonus')
+
+
+def build_sweep_variants(grid: Dict[str, list]) -> List[Dict]:
+    """ Декартово произведение вариантов параметров.
+        grid: {параметр DiceDistribution или to_hit_bonus/damage_bonus: [значения]}
+    """
+    keys = list(grid)
+    return [dict(zip(keys, values)) for values in itertools.product(*(grid[key] for key in keys))]
+
+
+def sweep_expected_damage(base_params: Dict, variants: List[Dict], ac_values) -> np.ndarray:
+    """ Средний урон за атаку для набора вариантов параметров: матрица (вариант x AC).
+        Варианты, различающиеся только плоскими модификаторами, делят таблицы d20
+        и свертки урона: модификатор попадания сдвигает AC, модификатор урона - среднее
+    """
+    ac_values = np.asarray(ac_values)
+    hit_models = {}
+    damage_models = {}
+    matrix = np.empty((len(variants), len(ac_values)))
+
+    for row, variant in enumerate(variants):
+        params = {**base_params, **{k: v for k, v in variant.items() if k not in SWEEP_BONUS_KEYS}}
+
+        to_hit_dice, to_hit_flat = split_flat_modifier(params['to_hit_roll'])
+        to_hit_flat += variant.get('to_hit_bonus', 0)
+        hit_key = (to_hit_dice,
+                   params.get('crit_hit_number', 20),
+                   params.get('advantage_status', 0),
+                   bool(params.get('halfling_luck_active', False)))
+        if hit_key not in hit_models:
+            hit_models[hit_key] = DiceDistribution(
+                to_hit_dice,
+                crit_hit_number=hit_key[1],
+                advantage_status=hit_key[2],
+                halfling_luck_active=hit_key[3]
+            )
+        hit_model = hit_models[hit_key]
+
+        damage_dice, damage_flat = split_flat_modifier(params.get('damage_roll', ''))
+        damage_flat += variant.get('damage_bonus', 0)
+        damage_key = (damage_dice,
+                      bool(params.get('great_weapon_fighting_active', False)),
+                      params.get('per_hit_rider', ''))
+        if damage_key not in damage_models:
+            damage_models[damage_key] = DiceDistribution(
+                '', damage_dice, great_weapon_fighting_active=damage_key[1], per_hit_rider=damage_key[2]
+            )
+        avg_normal_dmg, avg_crit_dmg = damage_models[damage_key]._average_damage
+
+        # Модификатор попадания +k эквивалентен AC - k без модификатора
+        normal_hit = hit_model.normal_hit_probabilities(ac_values - to_hit_flat)
+        matrix[row] = ((avg_normal_dmg + damage_flat) * normal_hit
+                       + (avg_crit_dmg + damage_flat) * hit_model.critical_hit_probability)
+
+    return matrix
+
 
 def main():
     test_roll = DiceDistribution(to_hit_roll='7 + 1d4 - 5 + 1',
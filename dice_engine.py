@@ -0,0 +1,219 @@
+from collections import Counter
+from functools import lru_cache
+from math import comb
+from typing import Dict, Iterable, Tuple
+
+import numpy as np
+
+from dice_notation import EXPLODE_DEPTH, DiceTerm
+
+# Распределение суммы задается парой (offset, probs):
+# probs[i] - вероятность выпадения значения offset + i
+Distribution = Tuple[int, np.ndarray]
+
+# Начиная с этого произведения длин векторов свертка считается через FFT
+FFT_THRESHOLD = 4096
+
+
+def point_distribution(value: int = 0) -> Distribution:
+    """Вырожденное распределение: значение value с вероятностью 1"""
+    return value, np.ones(1)
+
+
+@lru_cache(maxsize=256)
+def compiled_die(faces: int, reroll: int = 0, explode: bool = False, minimum: int = 0) -> Distribution:
+    """ Распределение одного куба с модификаторами, кэшируется по спецификации.
+        reroll - значения не больше reroll перебрасываются один раз, остается второй результат;
+        explode - на максимуме бросается еще куб (не больше EXPLODE_DEPTH раз);
+        minimum - значения ниже minimum считаются равными ему
+    """
+    probs = np.full(faces, 1 / faces)
+
+    if reroll:
+        rerolled = min(reroll, faces)
+        probs[:rerolled] = 0
+        probs += rerolled / faces * (1 / faces)
+
+    if explode:
+        base = probs
+        for _ in range(EXPLODE_DEPTH):
+            # probs[i] - вероятность значения i + 1; максимум грани продолжается новым броском
+            exploded = np.zeros(faces + len(probs))
+            exploded[:faces - 1] = base[:faces - 1]
+            exploded[faces:] = base[faces - 1] * probs
+            probs = exploded
+
+    offset = 1
+    if minimum > 1:
+        probs = probs.copy()
+        probs[minimum - 1] += probs[:minimum - 1].sum()
+        probs = probs[minimum - 1:]
+        offset = minimum
+
+    probs.setflags(write=False)
+    return offset, probs
+
+
+def _keep_dice_distribution(die: Distribution, count: int, keep: int, highest: bool) -> Distribution:
+    """ Распределение суммы keep наибольших (или наименьших) из count кубов die.
+        Значения граней перебираются от лучших к худшим: на каждом шаге выбирается,
+        сколько из еще не распределенных кубов выпало этим значением
+    """
+    offset, probs = die
+    values = np.arange(offset, offset + len(probs))
+    order = range(len(values) - 1, -1, -1) if highest else range(len(values))
+    max_sum = keep * max(abs(int(values[0])), abs(int(values[-1])))
+
+    # states[j] - распределение суммы оставленных кубов, когда j кубов уже распределено
+    states = np.zeros((count + 1, max_sum + 1))
+    states[0, 0] = 1.0
+
+    for index in order:
+        value, prob = int(values[index]), probs[index]
+        if prob == 0:
+            continue
+
+        new_states = np.zeros_like(states)
+        for assigned in range(count + 1):
+            if not states[assigned].any():
+                continue
+            for same in range(count - assigned + 1):
+                weight = comb(count - assigned, same) * prob ** same
+                kept = min(same, max(0, keep - assigned))
+                shift = kept * value
+                new_states[assigned + same, shift:] += weight * states[assigned, :max_sum + 1 - shift]
+        states = new_states
+
+    return 0, states[count]
+
+
+@lru_cache(maxsize=256)
+def term_distribution(term: DiceTerm) -> Distribution:
+    """ Распределение группы кубов из нотации (4d6kh3, 1d10!, 8d6/2, -1d4), кэшируется по спецификации.
+        Массив вероятностей только для чтения
+    """
+    die = compiled_die(term.faces, term.reroll, term.explode, term.minimum)
+    keep = term.keep_highest or term.keep_lowest
+
+    if keep:
+        offset, probs = _keep_dice_distribution(die, term.count, keep, highest=bool(term.keep_highest))
+    else:
+        offset, probs = convolution_power(die, term.count)
+
+    if term.divisor > 1:
+        # Деление с округлением вниз: значения суммы неотрицательны
+        halved = np.arange(offset, offset + len(probs)) // term.divisor
+        offset = int(halved[0])
+        probs = np.bincount(halved - offset, weights=probs)
+
+    # Убираем нулевые хвосты: после выбора кубов сумма не начинается с нуля
+    nonzero = np.flatnonzero(probs)
+    offset, probs = offset + int(nonzero[0]), probs[nonzero[0]:nonzero[-1] + 1]
+
+    if term.sign < 0:
+        offset, probs = -(offset + len(probs) - 1), probs[::-1]
+
+    probs = probs.copy()
+    probs.setflags(write=False)
+    return offset, probs
+
+
+def convolve(first: Distribution, second: Distribution) -> Distribution:
+    """Распределение суммы двух независимых величин"""
+    first_offset, first_probs = first
+    second_offset, second_probs = second
+
+    if len(first_probs) * len(second_probs) < FFT_THRESHOLD:
+        probs = np.convolve(first_probs, second_probs)
+    else:
+        size = len(first_probs) + len(second_probs) - 1
+        fft_size = 1 << (size - 1).bit_length()
+        probs = np.fft.irfft(
+            np.fft.rfft(first_probs, fft_size) * np.fft.rfft(second_probs, fft_size),
+            fft_size
+        )[:size]
+        # Убираем численный шум FFT вокруг нулевых вероятностей
+        probs[probs < 1e-15] = 0
+
+    return first_offset + second_offset, probs
+
+
+def convolution_power(distribution: Distribution, count: int) -> Distribution:
+    """ Распределение суммы count независимых копий distribution.
+        Считается возведением в степень через квадраты: O(log count) сверток
+    """
+    result = point_distribution()
+
+    while count:
+        if count & 1:
+            result = convolve(result, distribution)
+        count >>= 1
+        if count:
+            distribution = convolve(distribution, distribution)
+
+    return result
+
+
+def _is_pooled(term: DiceTerm) -> bool:
+    """Группа кубов с выбором или делением: ее нельзя слить с такой же группой в одну большую"""
+    return bool(term.keep_highest or term.keep_lowest or term.divisor > 1)
+
+
+def dice_sum_distribution(dice_list: Iterable[DiceTerm],
+                          great_weapon_fighting: bool = False) -> Distribution:
+    """ Распределение суммы групп кубов из parse_dice_notation.
+        Одинаковые кубы без выбора и деления складываются в одну группу,
+        одинаковые прочие группы сворачиваются возведением в степень.
+        great_weapon_fighting добавляет переброс 1 и 2 всем кубам
+    """
+    groups = Counter()
+    for term in dice_list:
+        if great_weapon_fighting:
+            term = term._replace(reroll=max(term.reroll, 2))
+        if _is_pooled(term):
+            groups[term] += 1
+        else:
+            groups[term._replace(count=1)] += term.count
+
+    result = point_distribution()
+
+    for term, count in sorted(groups.items(), key=lambda item: item[0].faces):
+        if _is_pooled(term):
+            # Выбор и деление действуют на всю группу: 1d20kh1+1d20kh1 - это не 2d20kh1
+            term_dist = convolution_power(term_distribution(term), count)
+        else:
+            term_dist = term_distribution(term._replace(count=count))
+        result = convolve(result, term_dist)
+
+    return result
+
+
+def spectrum(distribution: Distribution, fft_size: int) -> np.ndarray:
+    """ Спектр распределения для свертки по кругу длины fft_size.
+        Значение v попадает в индекс v mod fft_size, поэтому смещения складываются при умножении
+    """
+    offset, probs = distribution
+    frequencies = np.arange(fft_size // 2 + 1)
+    return np.fft.rfft(probs, fft_size) * np.exp(-2j * np.pi * frequencies * (offset % fft_size) / fft_size)
+
+
+def spectrum_to_distribution(spectra: np.ndarray, fft_size: int, min_value: int, size: int) -> Distribution:
+    """ Обратное преобразование spectrum для одного спектра или батча спектров (по строкам).
+        min_value и size - заранее известный диапазон значений результата, size <= fft_size
+    """
+    probs = np.fft.irfft(spectra, fft_size, axis=-1)
+    probs = np.roll(probs, -(min_value % fft_size), axis=-1)[..., :size]
+    # Убираем численный шум FFT вокруг нулевых вероятностей
+    probs[probs < 1e-15] = 0
+
+    return min_value, probs
+
+
+def distribution_to_dict(distribution: Distribution, shift: int = 0) -> Dict[int, float]:
+    """Переводит (offset, probs) в словарь {значение: вероятность} без нулевых значений"""
+    offset, probs = distribution
+    return {
+        offset + shift + index: float(prob)
+        for index, prob in enumerate(probs)
+        if prob > 0
+    }
@@ -0,0 +1,219 @@
+import re
+from collections import Counter
+from typing import List, NamedTuple, Tuple
+
+# Больше кубов в группе с kh/kl не принимаем: точный расчет выбора кубов растет как N^2
+MAX_KEEP_DICE = 20
+
+# Сколько раз подряд может взорваться куб с '!'; дальше максимум грани остается как есть
+EXPLODE_DEPTH = 3
+
+# Бюджет расчета: нотацию сверх него отклоняет парсер, а с ним и валидатор параметров.
+# Граней у куба и кубов во всей нотации - не больше MAX_FACES и MAX_DICE,
+# сумма всех слагаемых - не больше MAX_SUPPORT разных значений
+MAX_FACES = 1000
+MAX_DICE = 1000
+MAX_SUPPORT = 100000
+
+# Выбор кубов (kh/kl) стоит порядка значений_куба * count^2 / 2 * максимум_суммы операций:
+# 20d100kh10 - около 2 * 10^7 (десятые доли секунды), 20d1000kh10 - уже секунды
+MAX_KEEP_WORK = 5 * 10 ** 7
+
+_NUMBER = r'(?:0|[1-9]\d*)'
+_POSITIVE = r'[1-9]\d*'
+
+# Слагаемое: NdM с модификаторами и делителем или целое число
+_TERM_PATTERN = re.compile(
+    rf'(?P<sign>[+-])?(?:'
+    rf'(?P<count>{_POSITIVE})?d(?P<faces>{_POSITIVE})'
+    rf'(?P<modifiers>(?:k[hl]?{_POSITIVE}|r{_POSITIVE}|!|min{_POSITIVE})*)'
+    rf'(?:/(?P<divisor>{_POSITIVE}))?'
+    rf'|(?P<flat>{_NUMBER}))'
+)
+_MODIFIER_PATTERN = re.compile(rf'(?P<name>kh|kl|k|r|!|min)(?P<value>{_POSITIVE})?')
+
+
+class DiceTerm(NamedTuple):
+    """ Группа одинаковых кубов: sign * (count d faces с модификаторами) // divisor.
+        keep_highest/keep_lowest - сколько кубов оставить (kh/kl), reroll - переброс
+        один раз значений не больше reroll (r), explode - взрыв на максимуме (!),
+        minimum - нижняя граница значения каждого куба (min)
+    """
+    count: int
+    faces: int
+    sign: int = 1
+    keep_highest: int = 0
+    keep_lowest: int = 0
+    reroll: int = 0
+    explode: bool = False
+    minimum: int = 0
+    divisor: int = 1
+
+    @property
+    def is_plain(self) -> bool:
+        """Обычные кубы NdM без модификаторов"""
+        return self == DiceTerm(self.count, self.faces, self.sign)
+
+    @property
+    def die_support(self) -> int:
+        """Число значений одного куба: взрыв добавляет до EXPLODE_DEPTH бросков"""
+        return self.faces * (EXPLODE_DEPTH + 1) if self.explode else self.faces
+
+    @property
+    def support(self) -> int:
+        """Число значений суммы группы до деления (верхняя оценка)"""
+        dice = self.keep_highest or self.keep_lowest or self.count
+        return dice * (self.die_support - 1) + 1
+
+    @property
+    def value_range(self) -> Tuple[int, int]:
+        """Наименьшее и наибольшее значение группы со знаком"""
+        dice = self.keep_highest or self.keep_lowest or self.count
+        low = dice * max(self.minimum, 1) // self.divisor
+        high = dice * self.die_support // self.divisor
+        return (low, high) if self.sign > 0 else (-high, -low)
+
+
+def _parse_term(match) -> DiceTerm:
+    sign = -1 if match['sign'] == '-' else 1
+    count = int(match['count'] or 1)
+    faces = int(match['faces'])
+    if faces > MAX_FACES or count > MAX_DICE:
+        raise ValueError(f'Слишком много граней или кубов (не больше d{MAX_FACES} и {MAX_DICE} кубов): {match[0]}')
+
+    modifiers = {}
+
+    for modifier in _MODIFIER_PATTERN.finditer(match['modifiers']):
+        name = 'kh' if modifier['name'] == 'k' else modifier['name']
+        if name in modifiers or (name in ('kh', 'kl') and {'kh', 'kl'} & set(modifiers)):
+            raise ValueError(f'Повторный модификатор {name} в {match[0]}')
+        modifiers[name] = int(modifier['value']) if modifier['value'] else True
+
+    keep = modifiers.get('kh') or modifiers.get('kl') or 0
+    if keep and (keep > count or count > MAX_KEEP_DICE):
+        raise ValueError(f'Нельзя оставить {keep} из {count} кубов: {match[0]}')
+    if modifiers.get('r', 0) >= faces or modifiers.get('min', 0) > faces:
+        raise ValueError(f'Модификатор вне граней куба: {match[0]}')
+    if '!' in modifiers and faces == 1:
+        raise ValueError(f'd1 не может взрываться: {match[0]}')
+
+    term = DiceTerm(
+        count=count,
+        faces=faces,
+        sign=sign,
+        keep_highest=modifiers.get('kh', 0),
+        keep_lowest=modifiers.get('kl', 0),
+        reroll=modifiers.get('r', 0),
+        explode='!' in modifiers,
+        minimum=modifiers.get('min', 0),
+        divisor=int(match['divisor'] or 1)
+    )
+
+    if keep and term.die_support * count * (count + 1) // 2 * term.support > MAX_KEEP_WORK:
+        raise ValueError(f'Слишком долгий расчет выбора кубов: {match[0]}')
+
+    return term
+
+
+def parse_dice_notation(notation: str) -> Tuple[List[DiceTerm], int]:
+    """ Функция принимает строку с нотацией дайс ролла
+        и возвращает список групп кубов DiceTerm
+        и сумму абсолютных модификаторов.
+        Некорректная нотация или нотация сверх бюджета расчета вызывает ValueError
+    """
+    if not notation or not notation.strip():
+        return [], 0
+
+    # Пробелы не должны разделять числа
+    if re.search(r'\d\s+\d', notation):
+        raise ValueError(f'Пробел внутри числа: {notation}')
+
+    clean_notation = notation.replace(' ', '').replace('к', 'd').replace('К', 'd').replace('D', 'd').lower()
+
+    dice = []
+    flat = 0
+    position = 0
+
+    while position < len(clean_notation):
+        match = _TERM_PATTERN.match(clean_notation, position)
+        # Знак обязателен между слагаемыми и не может висеть в конце
+        if not match or not match[0].lstrip('+-') or (position and not match['sign']):
+            raise ValueError(f'Некорректная нотация: {notation}')
+
+        if match['flat'] is not None:
+            flat += int(match[0])
+        else:
+            dice.append(_parse_term(match))
+
+        position = match.end()
+
+    if sum(term.count for term in dice) > MAX_DICE or sum(term.support for term in dice) > MAX_SUPPORT:
+        raise ValueError(f'Слишком много кубов для расчета: {notation}')
+
+    return dice, flat
+
+
+def dice_range(dice: List[DiceTerm], flat: int = 0) -> Tuple[int, int]:
+    """Наименьшее и наибольшее значение суммы групп кубов и модификатора"""
+    ranges = [term.value_range for term in dice]
+    return sum(low for low, _ in ranges) + flat, sum(high for _, high in ranges) + flat
+
+
+def format_dice_term(term: DiceTerm) -> str:
+    """Слагаемое в нотации со знаком: '+4d6kh3', '-1d4', '+8d6/2'"""
+    text = f"{'-' if term.sign < 0 else '+'}{term.count}d{term.faces}"
+    if term.keep_highest:
+        text += f'kh{term.keep_highest}'
+    if term.keep_lowest:
+        text += f'kl{term.keep_lowest}'
+    if term.reroll:
+        text += f'r{term.reroll}'
+    if term.explode:
+        text += '!'
+    if term.minimum:
+        text += f'min{term.minimum}'
+    if term.divisor > 1:
+        text += f'/{term.divisor}'
+
+    return text
+
+
+def _format_dice(dice: List[DiceTerm]) -> List[str]:
+    """ Слагаемые-кубы в каноническом порядке: сначала положительные, от больших граней к меньшим.
+        Обычные кубы с одинаковыми гранями складываются в одну группу
+    """
+    plain = Counter()
+    extended = []
+    for term in dice:
+        if term.is_plain:
+            plain[(term.sign, term.faces)] += term.count
+        else:
+            extended.append(term)
+
+    terms = [DiceTerm(count, faces, sign) for (sign, faces), count in plain.items()] + extended
+    terms.sort(key=lambda term: (term.sign < 0, -term.faces, not term.is_plain, format_dice_term(term)))
+
+    return [format_dice_term(term) for term in terms]
+
+
+def canonical_dice_notation(notation: str) -> str:
+    """ Приводит нотацию к каноническому виду: кубы сгруппированы и отсортированы,
+        модификаторы просуммированы. '7 + 1d4 - 5 + 1' и '1d4+3' дают одно и то же
+    """
+    if not notation or not notation.strip():
+        return ''
+
+    dice, flat = parse_dice_notation(notation)
+    terms = _format_dice(dice)
+
+    if flat or not terms:
+        terms.append(f'{flat:+d}')
+
+    return ''.join(terms).lstrip('+')
+
+
+def split_flat_modifier(notation: str) -> Tuple[str, int]:
+    """Разделяет нотацию на каноническую часть с кубами и сумму модификаторов"""
+    dice, flat = parse_dice_notation(notation)
+
+    return ''.join(_format_dice(dice)).lstrip('+'), flat
@@ -0,0 +1,328 @@
+from collections import Counter
+from functools import cached_property
+from statistics import NormalDist
+from typing import Dict, Iterable, Tuple
+
+import numpy as np
+
+from dice_notation import EXPLODE_DEPTH, DiceTerm, parse_dice_notation
+
+# Бюджет выборки по умолчанию и размер порции: память на порцию ~ chunk_size x число AC
+DEFAULT_SAMPLES = 1_000_000
+DEFAULT_CHUNK_SIZE = 50_000
+
+
+def _roll(rng: np.random.Generator, faces: int, reroll: int, size) -> np.ndarray:
+    """Броски куба; значения не больше reroll перебрасываются один раз"""
+    rolls = rng.integers(1, faces + 1, size=size)
+
+    if reroll:
+        rerolled = rolls <= reroll
+        rolls[rerolled] = rng.integers(1, faces + 1, size=int(rerolled.sum()))
+
+    return rolls
+
+
+def _roll_term(rng: np.random.Generator, term: DiceTerm, size: int) -> np.ndarray:
+    """Сумма группы кубов DiceTerm для size независимых бросков"""
+    rolls = _roll(rng, term.faces, term.reroll, (size, term.count))
+
+    if term.explode:
+        exploding = rolls == term.faces
+        for _ in range(EXPLODE_DEPTH):
+            if not exploding.any():
+                break
+            extra = _roll(rng, term.faces, term.reroll, int(exploding.sum()))
+            rolls[exploding] += extra
+            exploding[exploding] = extra == term.faces
+
+    if term.minimum:
+        np.maximum(rolls, term.minimum, out=rolls)
+
+    if term.keep_highest:
+        rolls = np.sort(rolls, axis=1)[:, -term.keep_highest:]
+    elif term.keep_lowest:
+        rolls = np.sort(rolls, axis=1)[:, :term.keep_lowest]
+
+    return term.sign * (rolls.sum(axis=1) // term.divisor)
+
+
+def sample_dice_sum(rng: np.random.Generator, dice_list: Iterable[DiceTerm], size: int,
+                    great_weapon_fighting: bool = False) -> np.ndarray:
+    """Выборка суммы групп кубов из parse_dice_notation (без модификаторов)"""
+    total = np.zeros(size, dtype=np.int64)
+
+    for term in dice_list:
+        if great_weapon_fighting:
+            term = term._replace(reroll=max(term.reroll, 2))
+        total += _roll_term(rng, term, size)
+
+    return total
+
+
+def sample_d20(rng: np.random.Generator, advantage_status: int, halfling_luck_active: bool,
+               size: int) -> np.ndarray:
+    """ Выборка итоговой грани d20. Halfling's Luck перебрасывает один куб с единицей;
+        если единицы на всех кубах, результат определяет переброшенный куб
+    """
+    rolls = rng.integers(1, 21, size=(size, 1 + abs(advantage_status)))
+    pick = np.min if advantage_status < 0 else np.max
+
+    if not halfling_luck_active:
+        return pick(rolls, axis=1)
+
+    ones = rolls == 1
+    lucky = np.flatnonzero(ones.any(axis=1))
+    all_ones = ones.all(axis=1)
+    new_faces = rng.integers(1, 21, size=size)
+
+    rolls[lucky, np.argmax(ones[lucky], axis=1)] = new_faces[lucky]
+    faces = pick(rolls, axis=1)
+    faces[all_ones] = new_faces[all_ones]
+
+    return faces
+
+
+def _add_counts(counter: Counter, values: np.ndarray) -> None:
+    unique, counts = np.unique(values, return_counts=True)
+    counter.update(dict(zip(unique.tolist(), counts.tolist())))
+
+
+class SampledDistribution:
+    """ Эмпирические распределения для параметров DiceDistribution методом Монте-Карло.
+        Броски генерируются порциями по chunk_size, поэтому память не зависит от samples.
+        При одинаковых seed и chunk_size результат воспроизводится в точности
+    """
+
+    def __init__(self, dice_dist, samples: int = DEFAULT_SAMPLES, chunk_size: int = DEFAULT_CHUNK_SIZE,
+                 seed: int = 0, confidence: float = 0.95):
+        self.dice_dist = dice_dist
+        self.samples = samples
+        self.chunk_size = chunk_size
+        self.seed = seed
+        self.confidence = confidence
+        self.z = NormalDist().inv_cdf((1 + confidence) / 2)
+
+    @cached_property
+    def _accumulated(self) -> Dict:
+        dice_dist = self.dice_dist
+        rng = np.random.default_rng(self.seed)
+
+        to_hit_dice, to_hit_flat = parse_dice_notation(dice_dist.to_hit_roll)
+        damage_dice, damage_flat = parse_dice_notation(dice_dist.damage_roll)
+        rider_dice, rider_flat = parse_dice_notation(dice_dist.per_hit_rider)
+        sneak_dice, sneak_flat = parse_dice_notation(dice_dist.once_per_turn_rider)
+        damage_flat += rider_flat
+
+        ac_values = list(dice_dist.ac_values)
+        # Последний столбец - target_ac для распределения урона за раунд
+        columns = np.array(ac_values + [dice_dist.target_ac])
+
+        totals = {
+            'ac_values': ac_values,
+            'crit_hits': 0,
+            'crit_misses': 0,
+            'to_hit': Counter(),
+            'normal_damage': Counter(),
+            'critical_damage': Counter(),
+            'round_damage': Counter(),
+            'attack_sum': np.zeros(len(ac_values)),
+            'attack_squares': np.zeros(len(ac_values)),
+            'round_sum': np.zeros(len(ac_values)),
+            'round_squares': np.zeros(len(ac_values))
+        }
+
+        def damage(size):
+            weapon = sample_dice_sum(rng, damage_dice, size, dice_dist.great_weapon_fighting_active)
+            return weapon + sample_dice_sum(rng, rider_dice, size)
+
+        for start in range(0, self.samples, self.chunk_size):
+            size = min(self.chunk_size, self.samples - start)
+            round_damage = np.zeros((size, len(columns)), dtype=np.int64)
+            landed = np.zeros((size, len(columns)), dtype=bool)
+
+            for attack in range(dice_dist.attacks_per_round):
+                faces = sample_d20(rng, dice_dist.advantage_status, dice_dist.halfling_luck_active, size)
+                is_crit = faces >= dice_dist.crit_hit_number
+                is_normal = ~is_crit & (faces != 1)
+                to_hit = faces + sample_dice_sum(rng, to_hit_dice, size) + to_hit_flat
+
+                normal_damage = damage(size) + damage_flat
+                # При крите кубы бросаются дважды, модификаторы добавляются один раз
+                critical_damage = damage(size) + damage(size) + damage_flat
+                hit_damage = np.where(is_crit, critical_damage, normal_damage)
+
+                sneak_damage = sample_dice_sum(rng, sneak_dice, size) + sneak_flat
+                sneak_damage += np.where(is_crit, sample_dice_sum(rng, sneak_dice, size), 0)
+
+                hits = is_crit[:, None] | (is_normal[:, None] & (to_hit[:, None] >= columns))
+                attack_damage = np.where(hits, hit_damage[:, None], 0)
+                # Урон раз в ход добавляется к первому попаданию раунда
+                round_damage += attack_damage + np.where(hits & ~landed, sneak_damage[:, None], 0)
+                landed |= hits
+
+                if attack == 0:
+                    totals['crit_hits'] += int(is_crit.sum())
+                    totals['crit_misses'] += int((faces == 1).sum())
+                    _add_counts(totals['to_hit'], to_hit[is_normal])
+                    _add_counts(totals['normal_damage'], normal_damage)
+                    _add_counts(totals['critical_damage'], critical_damage)
+                    totals['attack_sum'] += attack_damage[:, :-1].sum(axis=0)
+                    totals['attack_squares'] += (attack_damage[:, :-1].astype(float) ** 2).sum(axis=0)
+
+            totals['round_sum'] += round_damage[:, :-1].sum(axis=0)
+            totals['round_squares'] += (round_damage[:, :-1].astype(float) ** 2).sum(axis=0)
+            _add_counts(totals['round_damage'], round_damage[:, -1])
+
+        return totals
+
+    def _frequencies(self, counter: Counter) -> Dict[int, float]:
+        return {value: count / self.samples for value, count in sorted(counter.items())}
+
+    def _means(self, total: np.ndarray, squares: np.ndarray) -> Tuple[Dict, Dict]:
+        """Средние по AC и их доверительные интервалы"""
+        mean = total / self.samples
+        variance = np.maximum(squares / self.samples - mean ** 2, 0)
+        half_width = self.z * np.sqrt(variance / self.samples)
+        ac_values = self._accumulated['ac_values']
+
+        return (
+            {ac: float(m) for ac, m in zip(ac_values, mean)},
+            {ac: (float(m - h), float(m + h)) for ac, m, h in zip(ac_values, mean, half_width)}
+        )
+
+    def probability_interval(self, probability: float) -> Tuple[float, float]:
+        """Доверительный интервал эмпирической вероятности (нормальное приближение)"""
+        half_width = self.z * np.sqrt(probability * (1 - probability) / self.samples)
+        return max(probability - half_width, 0.0), min(probability + half_width, 1.0)
+
+    @property
+    def critical_hit_probability(self):
+        return self._accumulated['crit_hits'] / self.samples
+
+    @property
+    def critical_miss_probability(self):
+        return self._accumulated['crit_misses'] / self.samples
+
+    @cached_property
+    def to_hit_distribution(self):
+        return self._frequencies(self._accumulated['to_hit'])
+
+    @cached_property
+    def damage_distribution(self):
+        return (self._frequencies(self._accumulated['normal_damage']),
+                self._frequencies(self._accumulated['critical_damage']))
+
+    @cached_property
+    def round_damage_distribution(self):
+        return self._frequencies(self._accumulated['round_damage'])
+
+    @cached_property
+    def _attack_means(self):
+        return self._means(self._accumulated['attack_sum'], self._accumulated['attack_squares'])
+
+    @cached_property
+    def _round_means(self):
+        return self._means(self._accumulated['round_sum'], self._accumulated['round_squares'])
+
+    @property
+    def damage_vs_ac_distribution(self):
+        return self._attack_means[0]
+
+    @property
+    def damage_vs_ac_intervals(self):
+        return self._attack_means[1]
+
+    @property
+    def round_damage_vs_ac_distribution(self):
+        return self._round_means[0]
+
+    @property
+    def round_damage_vs_ac_intervals(self):
+        return self._round_means[1]
+
+
+def _max_probability_error(exact: Dict[int, float], sampled: Dict[int, float], samples: int) -> float:
+    """Наибольшее отклонение частот от точных вероятностей в стандартных ошибках"""
+    worst = 0.0
+
+    for value in set(exact) | set(sampled):
+        p = exact.get(value, 0.0)
+        deviation = abs(sampled.get(value, 0.0) - p)
+        if p <= 0 or p >= 1:
+            # Значение, которого не может быть, в выборке - явная ошибка
+            if deviation > 0:
+                return float('inf')
+            continue
+        worst = max(worst, float(deviation / np.sqrt(p * (1 - p) / samples)))
+
+    return worst
+
+
+def _max_mean_error(exact: Dict[int, float], sampled: Dict[int, float],
+                    intervals: Dict[int, Tuple[float, float]], z: float) -> float:
+    worst = 0.0
+
+    for ac, value in exact.items():
+        low, high = intervals[ac]
+        standard_error = (high - low) / (2 * z)
+        deviation = abs(sampled[ac] - value)
+        if standard_error == 0:
+            if deviation > 1e-9:
+                return float('inf')
+            continue
+        worst = max(worst, deviation / standard_error)
+
+    return worst
+
+
+def cross_check(dice_dist, samples: int = DEFAULT_SAMPLES, seed: int = 0, **kwargs) -> Dict[str, float]:
+    """ Сверяет точный расчет DiceDistribution с выборкой Монте-Карло.
+        Для каждой величины возвращает наибольшее отклонение в стандартных ошибках:
+        при верном расчете значения порядка 3-5, inf - выборка дала невозможное значение
+    """
+    sampled = SampledDistribution(dice_dist, samples=samples, seed=seed, **kwargs)
+    exact_normal, exact_crit = dice_dist.damage_distribution
+    sampled_normal, sampled_crit = sampled.damage_distribution
+    exact_to_hit = {value: p for value, p in dice_dist.to_hit_distribution.items() if p > 0}
+
+    report = {
+        'critical_hit': _max_probability_error({1: dice_dist.critical_hit_probability},
+                                               {1: sampled.critical_hit_probability}, samples),
+        'critical_miss': _max_probability_error({1: dice_dist.critical_miss_probability},
+                                                {1: sampled.critical_miss_probability}, samples),
+        'to_hit': _max_probability_error(exact_to_hit, sampled.to_hit_distribution, samples),
+        'normal_damage': _max_probability_error(exact_normal, sampled_normal, samples),
+        'critical_damage': _max_probability_error(exact_crit, sampled_crit, samples),
+        'damage_vs_ac': _max_mean_error(dice_dist.damage_vs_ac_distribution, sampled.damage_vs_ac_distribution,
+                                        sampled.damage_vs_ac_intervals, sampled.z),
+        'round_damage': _max_probability_error(dice_dist.round_damage_distribution,
+                                               sampled.round_damage_distribution, samples),
+        'round_damage_vs_ac': _max_mean_error(dice_dist.round_damage_vs_ac_distribution,
+                                              sampled.round_damage_vs_ac_distribution,
+                                              sampled.round_damage_vs_ac_intervals, sampled.z)
+    }
+
+    return report
+
+
+# Наборы параметров для сверки: смешанный случай со всеми механиками
+# и повторяющиеся группы с выбором и делением, которые нельзя сливать в одну группу
+CROSS_CHECK_CASES = (
+    dict(to_hit_roll='1d4r1 + 5', damage_roll='2d6kh1! + 1d8min2 + 3', great_weapon_fighting_active=True,
+         advantage_status=1, halfling_luck_active=True, attacks_per_round=2, once_per_turn_rider='2d6'),
+    dict(to_hit_roll='5', damage_roll='1d20kh1 + 1d20kh1 + 1d6/2 + 1d6/2'),
+)
+
+
+def main():
+    from dice_distribution import DiceDistribution
+
+    for params in CROSS_CHECK_CASES:
+        print(f"{params['to_hit_roll']} / {params['damage_roll']}")
+        for name, error in cross_check(DiceDistribution(**params), samples=200_000).items():
+            print(f'  {name:20}{error:8.2f}')
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,80 @@
+import sqlite3
+import threading
+from collections import OrderedDict
+from typing import Dict, List
+
+
+class FileIdStore:
+    """ Хранит file_id графиков, уже загруженных в Telegram.
+        Ключ - хэш канонических параметров расчета и тип графика.
+        Данные лежат в SQLite, поэтому переживают перезапуск бота.
+        Хранятся file_id последних max_entries расчетов: сверх предела вытесняются давно
+        не использованные. Порядок использования ведется в памяти, после перезапуска
+        он восстанавливается по порядку записи
+    """
+
+    def __init__(self, path: str = 'file_ids.sqlite3', max_entries: int = 10000):
+        self.max_entries = max_entries
+        self.lock = threading.Lock()
+        self.connection = sqlite3.connect(path, check_same_thread=False)
+        self.connection.execute(
+            'CREATE TABLE IF NOT EXISTS file_ids ('
+            '    key_hash TEXT NOT NULL,'
+            '    chart_type TEXT NOT NULL,'
+            '    file_id TEXT NOT NULL,'
+            '    PRIMARY KEY (key_hash, chart_type)'
+            ')'
+        )
+        self.connection.commit()
+
+        # Весь стор держим в памяти: чтение не ходит на диск
+        self.file_ids: 'OrderedDict[str, Dict[str, str]]' = OrderedDict()
+        for key_hash, chart_type, file_id in self.connection.execute(
+                'SELECT key_hash, chart_type, file_id FROM file_ids ORDER BY rowid'):
+            self.file_ids.setdefault(key_hash, {})[chart_type] = file_id
+            self.file_ids.move_to_end(key_hash)
+
+        with self.connection:
+            self._delete(self._prune())
+
+    def get(self, key_hash: str) -> Dict[str, str]:
+        """Возвращает {тип графика: file_id} для расчета или пустой словарь"""
+        with self.lock:
+            file_ids = self.file_ids.get(key_hash)
+            if file_ids is None:
+                return {}
+            self.file_ids.move_to_end(key_hash)
+            return dict(file_ids)
+
+    def put(self, key_hash: str, file_ids: Dict[str, str]) -> None:
+        """Сохраняет file_id всех графиков расчета одной транзакцией"""
+        with self.lock:
+            self.file_ids[key_hash] = dict(file_ids)
+            self.file_ids.move_to_end(key_hash)
+            with self.connection:
+                self._delete([key_hash] + self._prune())
+                self.connection.executemany(
+                    'INSERT INTO file_ids (key_hash, chart_type, file_id) VALUES (?, ?, ?)',
+                    [(key_hash, chart_type, file_id) for chart_type, file_id in file_ids.items()]
+                )
+
+    def discard(self, key_hash: str) -> None:
+        """Удаляет file_id расчета (например, если Telegram их больше не принимает)"""
+        with self.lock:
+            with self.connection:
+                self.connection.execute('DELETE FROM file_ids WHERE key_hash = ?', (key_hash,))
+            self.file_ids.pop(key_hash, None)
+
+    def _prune(self) -> List[str]:
+        """Вытесняет из памяти расчеты сверх max_entries, возвращает их ключи для удаления из базы"""
+        evicted = []
+        while len(self.file_ids) > self.max_entries:
+            evicted.append(self.file_ids.popitem(last=False)[0])
+        return evicted
+
+    def _delete(self, key_hashes: List[str]) -> None:
+        self.connection.executemany('DELETE FROM file_ids WHERE key_hash = ?', [(key_hash,) for key_hash in key_hashes])
+
+    def __len__(self) -> int:
+        with self.lock:
+            return len(self.file_ids)
@@ -7,7 +7,7 @@ def create_adv_type_menu():
     """Создает клавиатуру для выбора типа Advantage"""
     markup = InlineKeyboardMarkup(row_width=2)
     buttons = [
-        InlineKeyboardButton(name, callback_data=f'set_adv_type:{type}')
+        InlineKeyboardButton(name, callback_data=f"{PARAMETERS['advantage_status']['callback_prefix']}:{type}")
         for type, name in ADVANTAGE_TYPES.items()
     ]
     markup.add(*buttons)
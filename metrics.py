@@ -0,0 +1,210 @@
+import bisect
+import functools
+import inspect
+import threading
+import time
+from contextlib import contextmanager
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from typing import Callable, Dict, Tuple
+
+# Границы корзин гистограмм задержек в секундах
+LATENCY_BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0)
+
+Labels = Tuple[Tuple[str, str], ...]
+
+
+def _format_labels(labels: Labels, **extra) -> str:
+    pairs = list(labels) + [(key, value) for key, value in extra.items()]
+    if not pairs:
+        return ''
+    return '{' + ','.join(f'{key}="{value}"' for key, value in pairs) + '}'
+
+
+class Histogram:
+    """Гистограмма с фиксированными корзинами: счетчики, сумма и число наблюдений"""
+
+    def __init__(self, buckets=LATENCY_BUCKETS):
+        self.buckets = buckets
+        self.counts = [0] * (len(buckets) + 1)
+        self.total = 0.0
+        self.count = 0
+
+    def observe(self, value: float) -> None:
+        self.counts[bisect.bisect_left(self.buckets, value)] += 1
+        self.total += value
+        self.count += 1
+
+    def quantile(self, q: float) -> float:
+        """Оценка квантиля по корзинам: линейная интерполяция внутри корзины"""
+        if not self.count:
+            return 0.0
+
+        rank = q * self.count
+        cumulative = 0
+        for index, count in enumerate(self.counts):
+            if cumulative + count >= rank and count:
+                lower = self.buckets[index - 1] if index else 0.0
+                if index == len(self.buckets):
+                    return lower  # Выше последней границы оценить нельзя
+                return lower + (self.buckets[index] - lower) * (rank - cumulative) / count
+            cumulative += count
+
+        return self.buckets[-1]
+
+
+class Metrics:
+    """ Метрики бота: гистограммы задержек, счетчики и gauge-функции.
+        Отдаются в текстовом формате Prometheus (render) и кратко для админ-команды (summary)
+    """
+
+    def __init__(self, prefix: str = 'dice_bot'):
+        self.prefix = prefix
+        self.lock = threading.Lock()
+        self.histograms: Dict[str, Dict[Labels, Histogram]] = {}
+        self.counters: Dict[str, Dict[Labels, float]] = {}
+        self.gauges: Dict[str, Tuple[str, Callable[[], float]]] = {}
+        self.descriptions: Dict[str, str] = {}
+
+    def describe(self, name: str, description: str) -> None:
+        self.descriptions[name] = description
+
+    def observe(self, name: str, value: float, **labels) -> None:
+        key = tuple(sorted(labels.items()))
+        with self.lock:
+            series = self.histograms.setdefault(name, {})
+            if key not in series:
+                series[key] = Histogram()
+            series[key].observe(value)
+
+    def increment(self, name: str, amount: float = 1, **labels) -> None:
+        key = tuple(sorted(labels.items()))
+        with self.lock:
+            series = self.counters.setdefault(name, {})
+            series[key] = series.get(key, 0) + amount
+
+    def gauge(self, name: str, description: str, callback: Callable[[], float]) -> None:
+        """Значение gauge считается в момент выдачи метрик"""
+        self.gauges[name] = (description, callback)
+
+    @contextmanager
+    def timer(self, name: str, **labels):
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(name, time.perf_counter() - start, **labels)
+
+    def instrument_handler(self, handler):
+        """ Декоратор обработчика бота: время выполнения и число ошибок по имени обработчика.
+            Корутины оборачиваются корутиной, время считается до завершения await
+        """
+        if inspect.iscoroutinefunction(handler):
+            @functools.wraps(handler)
+            async def async_wrapper(*args, **kwargs):
+                start = time.perf_counter()
+                try:
+                    return await handler(*args, **kwargs)
+                except Exception:
+                    self.increment('handler_errors_total', handler=handler.__name__)
+                    raise
+                finally:
+                    self.observe('handler_seconds', time.perf_counter() - start, handler=handler.__name__)
+
+            return async_wrapper
+
+        @functools.wraps(handler)
+        def wrapper(*args, **kwargs):
+            start = time.perf_counter()
+            try:
+                return handler(*args, **kwargs)
+            except Exception:
+                self.increment('handler_errors_total', handler=handler.__name__)
+                raise
+            finally:
+                self.observe('handler_seconds', time.perf_counter() - start, handler=handler.__name__)
+
+        return wrapper
+
+    def render(self) -> str:
+        """Все метрики в текстовом формате Prometheus"""
+        lines = []
+
+        with self.lock:
+            for name, series in sorted(self.histograms.items()):
+                full_name = f'{self.prefix}_{name}'
+                if name in self.descriptions:
+                    lines.append(f'# HELP {full_name} {self.descriptions[name]}')
+                lines.append(f'# TYPE {full_name} histogram')
+                for labels, histogram in sorted(series.items()):
+                    cumulative = 0
+                    for bound, count in zip(histogram.buckets, histogram.counts):
+                        cumulative += count
+                        lines.append(f'{full_name}_bucket{_format_labels(labels, le=bound)} {cumulative}')
+                    lines.append(f'{full_name}_bucket{_format_labels(labels, le="+Inf")} {histogram.count}')
+                    lines.append(f'{full_name}_sum{_format_labels(labels)} {histogram.total}')
+                    lines.append(f'{full_name}_count{_format_labels(labels)} {histogram.count}')
+
+            for name, series in sorted(self.counters.items()):
+                full_name = f'{self.prefix}_{name}'
+                if name in self.descriptions:
+                    lines.append(f'# HELP {full_name} {self.descriptions[name]}')
+                lines.append(f'# TYPE {full_name} counter')
+                for labels, value in sorted(series.items()):
+                    lines.append(f'{full_name}{_format_labels(labels)} {value}')
+
+        for name, (description, callback) in sorted(self.gauges.items()):
+            full_name = f'{self.prefix}_{name}'
+            lines.append(f'# HELP {full_name} {description}')
+            lines.append(f'# TYPE {full_name} gauge')
+            lines.append(f'{full_name} {float(callback())}')
+
+        return '\n'.join(lines) + '\n'
+
+    def summary(self) -> str:
+        """Краткая HTML-сводка для админ-команды: p50/p99 по гистограммам и значения gauge"""
+        lines = ['📈 <b>Метрики</b>', '<pre>']
+
+        with self.lock:
+            for name, series in sorted(self.histograms.items()):
+                lines.append(name)
+                for labels, histogram in sorted(series.items()):
+                    label = ','.join(value for _, value in labels) or '-'
+                    lines.append(f'  {label:24}{histogram.count:>7} '
+                                 f'p50 {histogram.quantile(0.5) * 1000:7.1f}ms '
+                                 f'p99 {histogram.quantile(0.99) * 1000:7.1f}ms')
+
+            for name, series in sorted(self.counters.items()):
+                for labels, value in sorted(series.items()):
+                    label = ','.join(value for _, value in labels)
+                    lines.append(f'{name}{f" {label}" if label else ""}: {value:g}')
+
+        for name, (_, callback) in sorted(self.gauges.items()):
+            lines.append(f'{name}: {float(callback()):g}')
+
+        lines.append('</pre>')
+        return '\n'.join(lines)
+
+
+def start_metrics_server(metrics: Metrics, host: str = '127.0.0.1', port: int = 9108) -> ThreadingHTTPServer:
+    """Локальный HTTP-эндпоинт /metrics в фоновом потоке"""
+
+    class MetricsHandler(BaseHTTPRequestHandler):
+        def do_GET(self):
+            if self.path.split('?')[0] != '/metrics':
+                self.send_error(404)
+                return
+
+            body = metrics.render().encode('utf-8')
+            self.send_response(200)
+            self.send_header('Content-Type', 'text/plain; version=0.0.4; charset=utf-8')
+            self.send_header('Content-Length', str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+
+        def log_message(self, format, *args):
+            pass  # Запросы скрейпера не засоряют вывод бота
+
+    server = ThreadingHTTPServer((host, port), MetricsHandler)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+
+    return server
@@ -1,20 +1,131 @@
-import re
+from typing import Any, Dict, Optional, Tuple
+
+from dice_notation import canonical_dice_notation, dice_range, parse_dice_notation
+
+# Бюджет урона за раунд: сколько разных значений он может принять с учетом удвоения кубов
+# на крите и всех атак раунда. Столько же - предел длины FFT в dice_distribution (около 0,1 с)
+MAX_ROUND_VALUES = 1 << 18
 
 
 def validate_dice_notation(text):
-    """Проверяет корректность нотации броска костей D&D"""
+    """Проверяет корректность нотации броска костей D&D по грамматике parse_dice_notation"""
     if not text or not text.strip():
         return False
 
-    # Проверяем пробелы до их удаления - они не должны разделять числа
-    if re.search(r'\d\s+\d', text):
+    try:
+        parse_dice_notation(text)
+    except ValueError:
         return False
 
-    clean_text = text.replace(' ', '').replace('к', 'd').replace('К', 'd').replace('D', 'd').lower()
+    return True
+
+
+def _hit_range(notations) -> Tuple[int, int]:
+    """Диапазон урона одной атаки вместе с промахом (0) и критом (кубы удваиваются, модификаторы - нет)"""
+    dice, flat = [], 0
+    for notation in notations:
+        notation_dice, notation_flat = parse_dice_notation(notation)
+        dice += notation_dice
+        flat += notation_flat
+
+    low, high = dice_range(dice)
+    return min(0, low + flat, 2 * low + flat), max(0, high + flat, 2 * high + flat)
+
+
+def calculation_budget_error(params: Dict[str, Any]) -> Optional[str]:
+    """ Проверка параметров расчета вместе: каждое поле проходит свой валидатор, но урон за раунд
+        складывает удвоенные на крите кубы всех атак и может выйти за бюджет.
+        params - аргументы DiceDistribution; возвращает текст ошибки или None
+    """
+    if not params.get('damage_roll'):
+        return None
+
+    attacks = params.get('attacks_per_round', 1)
+    once_per_turn_rider = params.get('once_per_turn_rider', '')
+    attack_low, attack_high = _hit_range((params['damage_roll'], params.get('per_hit_rider', '')))
+    rider_low, rider_high = _hit_range((once_per_turn_rider,))
+    if attacks == 1 and (rider_low, rider_high) == (0, 0):
+        return None  # Урон за раунд не считается
 
-    pattern = r'^(?!.*[+-]$)(?!.*[+-]{2})(?!.*d[^0-9])(?!.*d$)(?!.*(^|[+-])0\d)(?!.*d0(?!\d))[+-]?(?:(?:[1-9]\d*)?d[1-9]\d*|[1-9]\d*|0)(?:[+-](?:(?:[1-9]\d*)?d[1-9]\d*|[1-9]\d*|0))*$'
+    values = attacks * (attack_high - attack_low) + rider_high - rider_low + 1
+    if values > MAX_ROUND_VALUES:
+        return (f'❌ Слишком тяжелый расчет урона за раунд: {values} возможных значений '
+                f'(не больше {MAX_ROUND_VALUES}). Уменьшите кубы урона, модификаторы или число атак')
 
-    return bool(re.match(pattern, clean_text))
+    return None
+
+
+def _parse_flag(text):
+    value = int(text)
+    if value not in (0, 1):
+        raise ValueError(text)
+    return value
+
+
+def _parse_advantage(text):
+    value = int(text)
+    if value not in ADVANTAGE_TYPES:
+        raise ValueError(text)
+    return value
+
+
+def _parse_crit(text):
+    value = int(text)
+    if not 1 < value <= 20:
+        raise ValueError(text)
+    return value
+
+
+# Параметры, которые можно варьировать в /compare: ключ команды -> (аргумент расчета, парсер значения)
+SWEEP_PARAMETERS = {
+    'hit': ('to_hit_bonus', int),
+    'dmg': ('damage_bonus', int),
+    'adv': ('advantage_status', _parse_advantage),
+    'gwf': ('great_weapon_fighting_active', _parse_flag),
+    'hl': ('halfling_luck_active', _parse_flag),
+    'crit': ('crit_hit_number', _parse_crit)
+}
+
+# Без аргументов /compare сравнивает +1 к попаданию и +2 к урону
+DEFAULT_SWEEP_GRID = {'to_hit_bonus': [0, 1], 'damage_bonus': [0, 2]}
+
+MAX_SWEEP_VARIANTS = 24
+
+
+def parse_sweep_grid(text):
+    """ Разбирает аргументы /compare вида 'hit=0,1 dmg=0,2 adv=0,1'.
+        Возвращает {аргумент расчета: [значения]} или None, если аргументы некорректны
+    """
+    grid = {}
+
+    for token in text.split():
+        key, _, values = token.partition('=')
+        if key not in SWEEP_PARAMETERS or not values:
+            return None
+
+        param, parser = SWEEP_PARAMETERS[key]
+        try:
+            grid[param] = list(dict.fromkeys(parser(value) for value in values.split(',')))
+        except ValueError:
+            return None
+
+    variants_count = 1
+    for values in grid.values():
+        variants_count *= len(values)
+    if variants_count > MAX_SWEEP_VARIANTS:
+        return None
+
+    return grid or dict(DEFAULT_SWEEP_GRID)
+
+
+def sweep_variant_label(variant):
+    """Короткая подпись варианта сравнения: 'hit+1 dmg+2 adv=1'"""
+    parts = []
+    for key, (param, _) in SWEEP_PARAMETERS.items():
+        if param in variant:
+            value = variant[param]
+            parts.append(f'{key}{value:+d}' if param.endswith('_bonus') else f'{key}={value}')
+    return ' '.join(parts)
 
 
 ADVANTAGE_TYPES = {
@@ -24,15 +135,34 @@ ADVANTAGE_TYPES = {
     2: 'Super Advantage'
 }
 
+CHART_DELIVERY_TYPES = {
+    'separate': 'Отдельные графики',
+    'album': 'Альбом',
+    'dashboard': 'Одна картинка',
+    'text': 'Только текст'
+}
+
 BOT_COMMANDS = {
     '/new_calc': 'Начать новый расчет',
     '/reset': 'Сбросить настройки расчета',
+    '/compare': 'Сравнить варианты билда (например: /compare hit=0,1 dmg=0,2)',
     '/help': 'Помощь по боту'
 }
 
+CHART_CAPTIONS = {
+    'to_hit': '🎯 To-Hit Distribution',
+    'normal_damage': '🩸 Normal Damage Distribution',
+    'critical_damage': '💥 Critical Damage Distribution',
+    'damage_vs_ac': '⚔️🛡️ Average Damage vs AC Graph',
+    'dashboard': '📊 To-Hit & Damage Dashboard',
+    'sweep': '⚖️ Average Damage by Variant and AC',
+    'round_damage': '⚔️⚔️ Damage per Round Distribution'
+}
+
 PARAMETERS = {
     'advantage_status': {
         'type': 'inline_button',
+        'callback_prefix': 'set_adv_type',
         'short_name': 'Тип броска',
         'default': 0,
         'display_name': 'Тип броска',
@@ -55,6 +185,7 @@ PARAMETERS = {
         'display_value': lambda value: f"<code>{value}</code>" if value else "<code>Не задан</code>",
         'emoji': '🎯',
         'validator': validate_dice_notation,
+        'normalizer': canonical_dice_notation,
         'error_text': '❌ Неверное значение! Введите корректную нотацию броска (например: <code>1d4 + 7</code>)',
         'description': (
             'Бонусы к броску на попадание (без d20)\n'
@@ -73,13 +204,20 @@ PARAMETERS = {
         'display_value': lambda value: f"<code>{value}</code>" if value else "<code>Не задан</code>",
         'emoji': '🩸',
         'validator': validate_dice_notation,
+        'normalizer': canonical_dice_notation,
         'error_text': '❌ Неверное значение! Введите корректную нотацию броска (например: <code>2d6 + 1d8 + 3</code>)',
         'description': (
             'Формула урона при успешном попадании\n'
             '<b>Примеры:</b>\n'
             '• <code>2d6 + 4</code>\n'
             '• <code>1d8 + 2d6 + 3</code>\n'
-            '• <code>d10 + 5 - d4</code>'
+            '• <code>d10 + 5 - d4</code>\n'
+            '<b>Модификаторы кубов:</b>\n'
+            '• <code>4d6kh3</code> / <code>2d20kl1</code> - оставить наибольшие / наименьшие\n'
+            '• <code>1d8r1</code> - перебросить 1 один раз\n'
+            '• <code>1d10!</code> - взрывающийся куб\n'
+            '• <code>2d6min2</code> - значения куба не ниже 2\n'
+            '• <code>8d6/2</code> - половина суммы с округлением вниз'
         )
     },
 
@@ -114,6 +252,84 @@ PARAMETERS = {
         'display_value': lambda value: '✅' if value == 1 else '❌',
         'emoji': '🍀',
         'description': 'Расовая особенность Полуросликов\nПозволяет перебросить d20 при выпадении <b>1</b>'
+    },
+
+    'attacks_per_round': {
+        'type': 'user_text',
+        'short_name': 'Атаки',
+        'default': 1,
+        'display_name': 'Атак за раунд',
+        'display_value': lambda value: f"{value}",
+        'emoji': '⚔️',
+        'validator': lambda text: text.isdigit() and 1 <= int(text) <= 8,
+        'converter': lambda text: int(text),
+        'error_text': '❌ Неверное значение! Введите число от 1 до 8',
+        'description': 'Сколько одинаковых атак персонаж делает за раунд (Extra Attack, Flurry of Blows)'
+    },
+
+    'per_hit_rider': {
+        'type': 'user_text',
+        'short_name': 'За попадание',
+        'default': '',
+        'display_name': 'Доп. урон за каждое попадание',
+        'display_value': lambda value: f"<code>{value}</code>" if value else "<code>Нет</code>",
+        'emoji': '🏹',
+        'validator': validate_dice_notation,
+        'normalizer': canonical_dice_notation,
+        'error_text': '❌ Неверное значение! Введите корректную нотацию броска (например: <code>1d6</code>)',
+        'description': (
+            "Урон, который добавляется к каждому попаданию (Hunter's Mark, Hex).\n"
+            'Кубы удваиваются при крите, Great Weapon Fighting на них не действует.\n'
+            'Введите <code>0</code>, чтобы убрать'
+        )
+    },
+
+    'once_per_turn_rider': {
+        'type': 'user_text',
+        'short_name': 'Раз в ход',
+        'default': '',
+        'display_name': 'Доп. урон раз в ход',
+        'display_value': lambda value: f"<code>{value}</code>" if value else "<code>Нет</code>",
+        'emoji': '🥷',
+        'validator': validate_dice_notation,
+        'normalizer': canonical_dice_notation,
+        'error_text': '❌ Неверное значение! Введите корректную нотацию броска (например: <code>3d6</code>)',
+        'description': (
+            'Урон, который добавляется к первому попаданию за раунд (Sneak Attack).\n'
+            'Кубы удваиваются, если первое попадание критическое.\n'
+            'Введите <code>0</code>, чтобы убрать'
+        )
+    },
+
+    'target_ac': {
+        'type': 'user_text',
+        'short_name': 'AC цели',
+        'default': 15,
+        'display_name': 'AC цели для урона за раунд',
+        'display_value': lambda value: f"{value}",
+        'emoji': '🛡️',
+        'validator': lambda text: text.isdigit() and 1 <= int(text) <= 40,
+        'converter': lambda text: int(text),
+        'error_text': '❌ Неверное значение! Введите число от 1 до 40',
+        'description': 'Класс доспеха, для которого строится распределение урона за раунд'
+    },
+
+    'chart_delivery': {
+        'type': 'choice',
+        'short_name': 'Графики',
+        'default': 'separate',
+        'options': CHART_DELIVERY_TYPES,
+        'affects_calculation': False,
+        'display_name': 'Отправка графиков',
+        'display_value': lambda value: CHART_DELIVERY_TYPES[value],
+        'emoji': '🖼️',
+        'description': (
+            'Как присылать графики (переключается по кругу):\n'
+            '• <b>Отдельные графики</b> - каждый график отдельным сообщением\n'
+            '• <b>Альбом</b> - все графики одним альбомом\n'
+            '• <b>Одна картинка</b> - все графики на одном изображении\n'
+            '• <b>Только текст</b> - сводка цифрами без графиков, приходит мгновенно'
+        )
     }
 }
 #  🛡️
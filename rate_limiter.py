@@ -0,0 +1,72 @@
+import time
+from typing import Dict
+
+
+class TokenBucket:
+    """Ведро токенов: rate токенов в секунду, не больше capacity подряд"""
+
+    __slots__ = ('rate', 'capacity', 'tokens', 'updated_at')
+
+    def __init__(self, rate: float, capacity: float, now: float):
+        self.rate = rate
+        self.capacity = capacity
+        self.tokens = capacity
+        self.updated_at = now
+
+    def refill(self, now: float) -> None:
+        self.tokens = min(self.capacity, self.tokens + (now - self.updated_at) * self.rate)
+        self.updated_at = now
+
+    def consume(self, now: float) -> bool:
+        self.refill(now)
+        if self.tokens < 1:
+            return False
+        self.tokens -= 1
+        return True
+
+
+class RequestLimiter:
+    """ Ограничение тяжелых запросов: ведро токенов на пользователя и общий предел
+        одновременно выполняемых запросов. Вызывается только из цикла событий бота,
+        поэтому блокировки не нужны
+    """
+
+    def __init__(self, rate: float = 0.5, burst: int = 3, max_concurrent: int = 32,
+                 prune_interval: float = 300):
+        self.rate = rate
+        self.burst = burst
+        self.max_concurrent = max_concurrent
+        self.prune_interval = prune_interval
+        self.buckets: Dict[int, TokenBucket] = {}
+        self.active = 0
+        self.pruned_at = time.monotonic()
+
+    def allow(self, user_id: int) -> bool:
+        """Списывает токен пользователя; False - пользователь превысил свой лимит"""
+        now = time.monotonic()
+        if now - self.pruned_at > self.prune_interval:
+            self._prune(now)
+
+        bucket = self.buckets.get(user_id)
+        if bucket is None:
+            bucket = self.buckets[user_id] = TokenBucket(self.rate, self.burst, now)
+
+        return bucket.consume(now)
+
+    def try_acquire(self) -> bool:
+        """Занимает место среди выполняемых запросов; False - бот перегружен"""
+        if self.active >= self.max_concurrent:
+            return False
+        self.active += 1
+        return True
+
+    def release(self) -> None:
+        self.active -= 1
+
+    def _prune(self, now: float) -> None:
+        # Полное ведро ничем не отличается от нового, его можно забыть
+        for user_id, bucket in list(self.buckets.items()):
+            bucket.refill(now)
+            if bucket.tokens >= bucket.capacity:
+                del self.buckets[user_id]
+        self.pruned_at = now
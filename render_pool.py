@@ -0,0 +1,143 @@
+import threading
+import time
+from concurrent.futures import Future, ProcessPoolExecutor, wait
+from concurrent.futures.process import BrokenProcessPool
+from typing import Any, Dict, List, Optional
+
+
+class RenderPoolBusy(Exception):
+    """Очередь рендера заполнена, новую задачу принять нельзя"""
+
+
+def _warm_worker():
+    # matplotlib и движок распределений импортируются один раз на процесс
+    import chart_renderer  # noqa: F401
+    import dice_distribution  # noqa: F401
+
+
+def _noop():
+    return None
+
+
+def render_job(params: Dict[str, Any], render_options: Dict[str, Any]) -> Dict[str, Any]:
+    """ Считает распределения и рендерит графики в процессе-воркере.
+        params - аргументы DiceDistribution, render_options - аргументы render_charts.
+        Возвращает только изображения и timings - секунды по этапам: parse, distribution,
+        render (draw и encode - его части); распределения обратно в бот не передаются
+    """
+    from chart_renderer import get_renderer
+    from dice_distribution import DiceDistribution
+
+    timings = {}
+    start = time.perf_counter()
+
+    # Расчеты ленивые (cached_property): обращения к свойствам запускают их по этапам
+    dice_dist = DiceDistribution(**params)
+    for notation in ('_to_hit_notation', '_damage_notation', '_per_hit_rider_notation'):
+        getattr(dice_dist, notation)
+    parsed = time.perf_counter()
+    timings['parse'] = parsed - start
+
+    calculated_properties = ['to_hit_distribution']
+    if dice_dist.damage_roll:
+        calculated_properties += ['damage_distribution', 'damage_vs_ac_distribution']
+        if dice_dist.has_round:
+            calculated_properties.append('round_damage_distribution')
+    for name in calculated_properties:
+        getattr(dice_dist, name)
+    calculated = time.perf_counter()
+    timings['distribution'] = calculated - parsed
+
+    renderer = get_renderer(render_options.get('preset', 'standard'))
+    renderer.timings.update(draw=0.0, encode=0.0)
+    charts = dice_dist.render_charts(**render_options)
+    timings['render'] = time.perf_counter() - calculated
+    if render_options.get('renderer', 'fast') == 'fast' or render_options.get('layout') == 'dashboard':
+        timings.update(renderer.timings)
+
+    return {'charts': charts, 'timings': timings}
+
+
+def sweep_job(base_params: Dict[str, Any], variants, ac_values, labels,
+              render_options: Dict[str, Any]) -> bytes:
+    """Считает матрицу сравнения вариантов и рендерит ее тепловой картой"""
+    from chart_renderer import get_renderer
+    from dice_distribution import sweep_expected_damage
+
+    matrix = sweep_expected_damage(base_params, variants, ac_values)
+
+    return get_renderer(render_options.get('preset', 'standard')).render_sweep(labels, ac_values, matrix)
+
+
+class RenderPool:
+    """ Пул процессов для расчетов и рендера графиков.
+        Число одновременно принятых задач ограничено: workers выполняются,
+        еще max_queue ждут в очереди.
+        Аварийно завершившийся воркер ломает ProcessPoolExecutor навсегда (BrokenProcessPool):
+        такой executor заменяется новым, а задачи, которые были в нем, завершаются с этой ошибкой
+    """
+
+    def __init__(self, workers: int = 2, max_queue: int = 16,
+                 render_options: Optional[Dict[str, Any]] = None):
+        self.workers = workers
+        self.max_queue = max_queue
+        self.render_options = render_options or {}
+        self.restart_lock = threading.Lock()
+        self.executor = self._create_executor()
+        self.slots = threading.BoundedSemaphore(workers + max_queue)
+
+    def _create_executor(self) -> ProcessPoolExecutor:
+        return ProcessPoolExecutor(max_workers=self.workers, initializer=_warm_worker)
+
+    def _restart(self, broken: ProcessPoolExecutor) -> None:
+        """Заменяет сломанный executor; повторные вызовы для уже замененного ничего не делают"""
+        with self.restart_lock:
+            if self.executor is not broken:
+                return
+            print("♻️ Воркер рендера завершился аварийно, пул процессов перезапущен")
+            self.executor = self._create_executor()
+        broken.shutdown(wait=False, cancel_futures=True)
+
+    def _on_done(self, executor: ProcessPoolExecutor, future: Future) -> None:
+        self.slots.release()
+        # Воркер упал во время задачи: чиним пул сразу, не дожидаясь следующей отправки
+        if not future.cancelled() and isinstance(future.exception(), BrokenProcessPool):
+            self._restart(executor)
+
+    def warm_up(self, block: bool = True) -> List[Future]:
+        """ Запускает воркеры заранее, чтобы первый расчет не ждал импорта matplotlib.
+            block=False - не ждать: воркеры прогреваются, пока бот уже отвечает
+        """
+        futures = [self.executor.submit(_noop) for _ in range(self.workers)]
+        if block:
+            wait(futures)
+        return futures
+
+    def submit(self, params: Dict[str, Any], layout: str = 'separate') -> Future:
+        return self._submit(render_job, params, {**self.render_options, 'layout': layout})
+
+    def submit_sweep(self, base_params: Dict[str, Any], variants, ac_values, labels) -> Future:
+        return self._submit(sweep_job, base_params, variants, list(ac_values), labels, self.render_options)
+
+    def _submit(self, fn, *args) -> Future:
+        """Отправляет задачу; BrokenProcessPool - пул не удалось восстановить и после перезапуска"""
+        if not self.slots.acquire(blocking=False):
+            raise RenderPoolBusy()
+
+        try:
+            executor = self.executor
+            try:
+                future = executor.submit(fn, *args)
+            except BrokenProcessPool:
+                self._restart(executor)
+                executor = self.executor
+                future = executor.submit(fn, *args)
+        except Exception:
+            self.slots.release()
+            raise
+
+        future.add_done_callback(lambda done: self._on_done(executor, done))
+        return future
+
+    def shutdown(self) -> None:
+        self.executor.shutdown(wait=False, cancel_futures=True)
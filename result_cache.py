@@ -0,0 +1,100 @@
+import hashlib
+import threading
+from collections import OrderedDict
+from typing import Any, Dict, Hashable, Optional, Tuple
+
+from params import PARAMETERS
+
+
+def result_layout(delivery: str) -> str:
+    """ Вид результата для способа отправки: 'text' - сводка, 'dashboard' - одна картинка,
+        'separate' - отдельные графики (их же присылает альбом)
+    """
+    return delivery if delivery in ('text', 'dashboard') else 'separate'
+
+
+def make_cache_key(user_data: Dict[str, Any], layout: str) -> Tuple:
+    """ Строит ключ кэша из параметров расчета и вида результата (result_layout).
+        Значения приводятся к каноническому виду через 'normalizer' из PARAMETERS,
+        поэтому одинаковые по смыслу броски разных пользователей дают один ключ.
+        Параметры, не влияющие на расчет (affects_calculation), в ключ не входят:
+        отдельные графики и альбом используют одни и те же изображения
+    """
+    key = []
+
+    for param_slug, param_data in PARAMETERS.items():
+        if not param_data.get('affects_calculation', True):
+            continue
+        value = user_data.get(param_slug, param_data['default'])
+        if 'normalizer' in param_data:
+            value = param_data['normalizer'](value)
+        key.append((param_slug, value))
+
+    key.append(('layout', layout))
+    return tuple(key)
+
+
+def cache_key_hash(cache_key: Tuple) -> str:
+    """Стабильный между перезапусками хэш ключа кэша"""
+    return hashlib.sha256(repr(cache_key).encode('utf-8')).hexdigest()
+
+
+class ResultCache:
+    """ Общий для всех пользователей LRU-кэш результатов расчета.
+        Ограничен числом записей и суммарным размером в байтах.
+        Хранятся только готовые результаты - PNG графиков или текст сводки, размер которых известен.
+        Числовые распределения не кэшируются: их никто не читал повторно, а их размер не учитывался
+        в max_bytes; повторный расчет без рендера дешев
+    """
+
+    def __init__(self, max_entries: int = 512, max_bytes: int = 256 * 1024 * 1024):
+        self.max_entries = max_entries
+        self.max_bytes = max_bytes
+        self.entries: 'OrderedDict[Hashable, Tuple[Any, int]]' = OrderedDict()
+        self.total_bytes = 0
+        self.hits = 0
+        self.misses = 0
+        self.lock = threading.Lock()
+
+    def get(self, key: Hashable) -> Optional[Any]:
+        with self.lock:
+            entry = self.entries.get(key)
+            if entry is None:
+                self.misses += 1
+                return None
+
+            self.entries.move_to_end(key)
+            self.hits += 1
+            return entry[0]
+
+    def put(self, key: Hashable, value: Any, size: int = 0) -> None:
+        with self.lock:
+            if size > self.max_bytes:
+                return  # Запись не поместится даже в пустой кэш
+
+            previous = self.entries.pop(key, None)
+            if previous is not None:
+                self.total_bytes -= previous[1]
+
+            self.entries[key] = (value, size)
+            self.total_bytes += size
+
+            while len(self.entries) > self.max_entries or self.total_bytes > self.max_bytes:
+                _, (_, evicted_size) = self.entries.popitem(last=False)
+                self.total_bytes -= evicted_size
+
+    def clear(self) -> None:
+        with self.lock:
+            self.entries.clear()
+            self.total_bytes = 0
+
+    def stats(self) -> Dict[str, Any]:
+        with self.lock:
+            requests = self.hits + self.misses
+            return {
+                'entries': len(self.entries),
+                'bytes': self.total_bytes,
+                'hits': self.hits,
+                'misses': self.misses,
+                'hit_rate': self.hits / requests if requests else 0.0
+            }
@@ -0,0 +1,340 @@
+""" Хранилища сессий за SessionManager.
+
+    Локальное хранилище (shared = False) нужно только одному процессу: SessionManager держит
+    сессии в памяти и при промахе читает их из хранилища (read-through), а изменения пишутся
+    отложенно - копятся и раз в flush_interval секунд уходят одной транзакцией,
+    несколько изменений одной сессии за это время дают одну запись.
+
+    Общее хранилище (shared = True) читают и пишут несколько воркеров бота. Тогда SessionManager
+    не держит копий в памяти: каждое чтение идет в хранилище, а каждое изменение - атомарное
+    чтение-слияние-запись (update), поэтому воркеры видят изменения друг друга сразу
+    и не затирают чужие поля.
+
+    Общие хранилища наследуют SharedSessionBackend: без update и count такой класс не создается.
+
+    memory - сессии только в памяти процесса (как раньше), sqlite - файл в режиме WAL
+    (shared=True - SharedSQLiteBackend для нескольких процессов на одной машине),
+    redis - общий сервер (нужен пакет redis)
+"""
+import atexit
+import json
+import sqlite3
+import threading
+import time
+from abc import ABC, abstractmethod
+from typing import Any, Dict, Optional
+
+from session_manager import Session
+
+
+def session_to_json(session: Session) -> str:
+    return json.dumps({
+        'step': session.step,
+        'data': session.data,
+        'created_at': session.created_at,
+        'updated_at': session.updated_at
+    }, ensure_ascii=False)
+
+
+def session_from_json(record: str) -> Session:
+    return Session(**json.loads(record))
+
+
+class SessionBackend(ABC):
+    """Интерфейс хранилища сессий"""
+
+    shared = False
+
+    @abstractmethod
+    def load(self, user_id: int) -> Optional[Session]:
+        """Сохраненная сессия или None"""
+
+    @abstractmethod
+    def save(self, user_id: int, session: Session) -> None:
+        """Сохраняет сессию целиком (локальное хранилище, можно отложенно)"""
+
+    @abstractmethod
+    def delete(self, user_id: int) -> None:
+        """Удаляет сессию"""
+
+    def purge(self, before: float) -> None:
+        """Удаляет сессии, не обновлявшиеся с before"""
+
+    def flush(self) -> None:
+        """Дописывает отложенные изменения"""
+
+    def close(self) -> None:
+        self.flush()
+
+
+class SharedSessionBackend(SessionBackend):
+    """ Хранилище, общее для нескольких воркеров: SessionManager не держит копий сессий в памяти,
+        а читает их через load и меняет через update
+    """
+
+    shared = True
+
+    @abstractmethod
+    def update(self, user_id: int, step: Optional[str], data: Dict[str, Any], now: float) -> Session:
+        """ Атомарно меняет шаг и дополняет данные сохраненной сессии.
+            Истекшая или отсутствующая сессия создается заново
+        """
+
+    @abstractmethod
+    def count(self, since: float) -> int:
+        """Число сессий, обновленных после since"""
+
+
+class MemoryBackend(SessionBackend):
+    """Без сохранения: сессии живут только в памяти SessionManager и теряются при перезапуске"""
+
+    def load(self, user_id: int) -> Optional[Session]:
+        return None
+
+    def save(self, user_id: int, session: Session) -> None:
+        pass
+
+    def delete(self, user_id: int) -> None:
+        pass
+
+
+class BatchedBackend(SessionBackend):
+    """ Основа хранилищ с отложенной записью: pending - {user_id: JSON сессии или None для удаления},
+        flushing - пачка, которая сейчас пишется. Чтение сначала смотрит в них, потом в хранилище.
+        В общем хранилище (SharedSessionBackend) отложенной записи нет: удаление и update пишутся сразу.
+        Наследники реализуют _read и _write
+    """
+
+    def __init__(self, session_timeout: int = 1800, flush_interval: float = 1.0):
+        self.session_timeout = session_timeout
+        self.flush_interval = flush_interval
+        self.lock = threading.Lock()
+        self.flush_lock = threading.Lock()
+        self.pending: Dict[int, Optional[str]] = {}
+        self.flushing: Dict[int, Optional[str]] = {}
+        self.closed = threading.Event()
+
+        if not self.shared:
+            threading.Thread(target=self._flush_loop, daemon=True).start()
+        atexit.register(self.close)
+
+    def _flush_loop(self):
+        while not self.closed.wait(self.flush_interval):
+            try:
+                self.flush()
+            except Exception as e:
+                print(f"❌ Ошибка записи сессий: {e}")
+
+    def load(self, user_id: int) -> Optional[Session]:
+        with self.lock:
+            for batch in (self.pending, self.flushing):
+                if user_id in batch:
+                    record = batch[user_id]
+                    return session_from_json(record) if record is not None else None
+
+        record = self._read(user_id)
+        return session_from_json(record) if record is not None else None
+
+    def save(self, user_id: int, session: Session) -> None:
+        # Сериализуем сразу: данные сессии могут измениться до записи
+        record = session_to_json(session)
+        with self.lock:
+            self.pending[user_id] = record
+
+    def delete(self, user_id: int) -> None:
+        if self.shared:
+            self._write({user_id: None})
+            return
+
+        with self.lock:
+            self.pending[user_id] = None
+
+    def _merge(self, record: Optional[str], step: Optional[str], data: Dict[str, Any], now: float) -> Session:
+        """Сессия из записи с примененным изменением; истекшая запись заменяется новой сессией"""
+        session = session_from_json(record) if record is not None else None
+        if session is None or now - session.updated_at > self.session_timeout:
+            session = Session(created_at=now)
+
+        if step is not None:
+            session.step = step
+        session.data.update(data)
+        session.updated_at = now
+
+        return session
+
+    def flush(self) -> None:
+        with self.flush_lock:
+            with self.lock:
+                batch, self.pending = self.pending, {}
+                self.flushing = batch
+            if not batch:
+                return
+
+            try:
+                self._write(batch)
+            except Exception:
+                # Не потерять изменения: возвращаем их, если новых для этих сессий еще нет
+                with self.lock:
+                    self.pending = {**batch, **self.pending}
+                raise
+            finally:
+                with self.lock:
+                    self.flushing = {}
+
+    def close(self) -> None:
+        if not self.closed.is_set():
+            self.closed.set()
+            self.flush()
+
+    @abstractmethod
+    def _read(self, user_id: int) -> Optional[str]:
+        """JSON сохраненной сессии или None"""
+
+    @abstractmethod
+    def _write(self, batch: Dict[int, Optional[str]]) -> None:
+        """Пишет пачку изменений: None - удалить сессию"""
+
+
+class SQLiteBackend(BatchedBackend):
+    """ Сессии в SQLite в режиме WAL: чтение не ждет записи.
+        Пачка изменений пишется одной транзакцией, там же удаляются истекшие сессии
+    """
+
+    def __init__(self, path: str = 'sessions.sqlite3', **options):
+        self.read_lock = threading.Lock()
+        self.write_lock = threading.Lock()
+        self.writer = sqlite3.connect(path, check_same_thread=False)
+        self.writer.execute('PRAGMA journal_mode=WAL')
+        self.writer.execute('PRAGMA synchronous=NORMAL')
+        self.writer.execute(
+            'CREATE TABLE IF NOT EXISTS sessions ('
+            '    user_id INTEGER PRIMARY KEY,'
+            '    record TEXT NOT NULL,'
+            '    updated_at REAL NOT NULL'
+            ')'
+        )
+        self.writer.execute('CREATE INDEX IF NOT EXISTS sessions_updated_at ON sessions (updated_at)')
+        self.writer.commit()
+        self.reader = sqlite3.connect(path, check_same_thread=False)
+
+        super().__init__(**options)
+
+    def _read(self, user_id: int) -> Optional[str]:
+        with self.read_lock:
+            row = self.reader.execute('SELECT record FROM sessions WHERE user_id = ?', (user_id,)).fetchone()
+        return row[0] if row else None
+
+    def _write(self, batch: Dict[int, Optional[str]]) -> None:
+        with self.write_lock, self.writer:
+            self.writer.executemany(
+                'INSERT OR REPLACE INTO sessions (user_id, record, updated_at) VALUES (?, ?, ?)',
+                [(user_id, record, json.loads(record)['updated_at'])
+                 for user_id, record in batch.items() if record is not None]
+            )
+            self.writer.executemany(
+                'DELETE FROM sessions WHERE user_id = ?',
+                [(user_id,) for user_id, record in batch.items() if record is None]
+            )
+            if not self.shared:
+                self.writer.execute('DELETE FROM sessions WHERE updated_at < ?', (time.time() - self.session_timeout,))
+
+    def close(self) -> None:
+        super().close()
+        self.writer.close()
+        self.reader.close()
+
+
+class SharedSQLiteBackend(SQLiteBackend, SharedSessionBackend):
+    """ Файл SQLite, общий для нескольких процессов: update идет в транзакции BEGIN IMMEDIATE,
+        которая блокирует запись других процессов на время чтения и слияния
+    """
+
+    def update(self, user_id: int, step: Optional[str], data: Dict[str, Any], now: float) -> Session:
+        with self.write_lock:
+            self.writer.execute('BEGIN IMMEDIATE')
+            try:
+                row = self.writer.execute('SELECT record FROM sessions WHERE user_id = ?', (user_id,)).fetchone()
+                session = self._merge(row[0] if row else None, step, data, now)
+                self.writer.execute(
+                    'INSERT OR REPLACE INTO sessions (user_id, record, updated_at) VALUES (?, ?, ?)',
+                    (user_id, session_to_json(session), now)
+                )
+                self.writer.commit()
+            except BaseException:
+                self.writer.rollback()
+                raise
+
+        return session
+
+    def count(self, since: float) -> int:
+        with self.read_lock:
+            return self.reader.execute('SELECT count(*) FROM sessions WHERE updated_at >= ?', (since,)).fetchone()[0]
+
+    def purge(self, before: float) -> None:
+        with self.write_lock, self.writer:
+            self.writer.execute('DELETE FROM sessions WHERE updated_at < ?', (before,))
+
+
+class RedisBackend(BatchedBackend, SharedSessionBackend):
+    """ Сессии в Redis: общие для нескольких воркеров бота. Истекают по TTL самого Redis,
+        update - транзакция WATCH/MULTI, повторяемая при конкурентном изменении ключа.
+        client - готовый клиент (например, локальная подмена для проверки), иначе подключение по url
+    """
+
+    def __init__(self, url: str = 'redis://localhost:6379/0', prefix: str = 'dice_bot:session:',
+                 client=None, **options):
+        if client is None:
+            try:
+                import redis
+            except ImportError as e:
+                raise ImportError("❌ Для хранения сессий в Redis нужен пакет redis: pip install redis") from e
+            client = redis.Redis.from_url(url)
+
+        self.client = client
+        self.prefix = prefix
+
+        super().__init__(**options)
+
+    @staticmethod
+    def _decode(record) -> Optional[str]:
+        return record.decode('utf-8') if isinstance(record, bytes) else record
+
+    def _read(self, user_id: int) -> Optional[str]:
+        return self._decode(self.client.get(f'{self.prefix}{user_id}'))
+
+    def _write(self, batch: Dict[int, Optional[str]]) -> None:
+        pipeline = self.client.pipeline(transaction=False)
+        for user_id, record in batch.items():
+            if record is None:
+                pipeline.delete(f'{self.prefix}{user_id}')
+            else:
+                pipeline.set(f'{self.prefix}{user_id}', record, ex=self.session_timeout)
+        pipeline.execute()
+
+    def update(self, user_id: int, step: Optional[str], data: Dict[str, Any], now: float) -> Session:
+        key = f'{self.prefix}{user_id}'
+
+        def merge(pipeline):
+            session = self._merge(self._decode(pipeline.get(key)), step, data, now)
+            pipeline.multi()
+            pipeline.set(key, session_to_json(session), ex=self.session_timeout)
+            return session
+
+        return self.client.transaction(merge, key, value_from_callable=True)
+
+    def count(self, since: float) -> int:
+        # Истекшие ключи Redis удаляет сам, since не нужен
+        return sum(1 for _ in self.client.scan_iter(match=f'{self.prefix}*', count=1000))
+
+
+def create_session_backend(backend: str = 'memory', path: str = 'sessions.sqlite3',
+                           url: str = 'redis://localhost:6379/0', shared: bool = False,
+                           **options) -> SessionBackend:
+    """Хранилище по имени из конфига: path - файл SQLite, url - адрес Redis, shared - общий SQLite"""
+    if backend == 'memory':
+        return MemoryBackend()
+    if backend == 'sqlite':
+        return SharedSQLiteBackend(path, **options) if shared else SQLiteBackend(path, **options)
+    if backend == 'redis':
+        return RedisBackend(url, **options)
+    raise ValueError(f"❌ Неизвестное хранилище сессий: {backend}")
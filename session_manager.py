@@ -1,68 +1,193 @@
+import heapq
 import time
 import threading
-from typing import Dict, Any, Optional
+from dataclasses import dataclass, field
+from typing import Dict, Any, List, Optional, Tuple
+
+
+@dataclass(slots=True)
+class Session:
+    """Сессия пользователя: текущий шаг диалога и параметры расчета"""
+    step: Optional[str] = None
+    data: Dict[str, Any] = field(default_factory=dict)
+    created_at: float = field(default_factory=time.time)
+    updated_at: float = field(default_factory=time.time)
 
 
 class SessionManager:
-    def __init__(self, session_timeout: int = 1800):
-        self.sessions: Dict[int, Dict[str, Any]] = {}
+    """ Сессии разбиты на полосы по user_id: у каждой полосы свой словарь и своя блокировка,
+        поэтому запись одного пользователя не ждет записей остальных.
+        Чтение идет без блокировки: выборка из словаря и чтение атрибута в CPython атомарны,
+        а запись меняет шаг и дополняет данные под блокировкой своей полосы.
+
+        Истечение сессий - по куче (updated_at, user_id): запись в нее добавляется только
+        при создании сессии, а устаревшая запись (сессию с тех пор обновляли) при извлечении
+        возвращается в кучу с новым временем. Раз в cleanup_interval секунд из кучи извлекаются
+        только истекшие сессии, без обхода всех. Вершина кучи - заодно и давно не использованная
+        сессия, поэтому по ней же вытесняются сессии сверх max_sessions.
+
+        backend - хранилище из session_backends: изменения сохраняются в него, а сессии,
+        которых нет в памяти (после перезапуска или вытеснения), читаются из него при обращении.
+        Общее хранилище (backend.shared - несколько воркеров на одной очереди обновлений) в памяти
+        не копируется: каждое чтение идет в хранилище, каждое изменение сразу пишется в него
+        атомарно, а истечением и подсчетом сессий занимается само хранилище
+    """
+
+    def __init__(self, session_timeout: int = 1800, stripes: int = 64,
+                 cleanup_interval: float = 5, max_sessions: int = 100000, backend=None):
+        if backend is None:
+            from session_backends import MemoryBackend
+            backend = MemoryBackend()
+
+        self.backend = backend
         self.session_timeout = session_timeout
-        self.lock = threading.Lock()
+        self.stripes = stripes
+        self.cleanup_interval = cleanup_interval
+        self.max_sessions = max_sessions
+        self.locks = [threading.Lock() for _ in range(stripes)]
+        self.shards: List[Dict[int, Session]] = [{} for _ in range(stripes)]
+        # Порядок блокировок: сначала expiry_lock, потом блокировка полосы
+        self.expiry_lock = threading.Lock()
+        self.expiry_heap: List[Tuple[float, int]] = []
         self._start_cleanup()
 
     def _start_cleanup(self):
         def cleanup():
             while True:
-                time.sleep(300)
+                time.sleep(self.cleanup_interval)
                 self._cleanup_expired()
         threading.Thread(target=cleanup, daemon=True).start()
 
+    def _lookup(self, user_id: int) -> Optional[Session]:
+        if self.backend.shared:
+            session = self.backend.load(user_id)
+            if session is None or time.time() - session.updated_at > self.session_timeout:
+                return None
+            return session
+
+        session = self.shards[user_id % self.stripes].get(user_id)
+        return session if session is not None else self._load(user_id)
+
+    def _load(self, user_id: int) -> Optional[Session]:
+        """Сессия из хранилища в память; None, если ее нет или она истекла"""
+        session = self.backend.load(user_id)
+        if session is None or time.time() - session.updated_at > self.session_timeout:
+            return None
+
+        stripe = user_id % self.stripes
+        with self.locks[stripe]:
+            cached = self.shards[stripe].setdefault(user_id, session)
+
+        if cached is session:
+            self._index(user_id, session.updated_at)
+        return cached
+
+    def _index(self, user_id: int, stamp: float) -> None:
+        with self.expiry_lock:
+            heapq.heappush(self.expiry_heap, (stamp, user_id))
+            if len(self) > self.max_sessions:
+                self._evict(time.time())
+
     def update_session(self, user_id: int, step: Optional[str] = None, **data) -> None:
-        with self.lock:
+        if self.backend.shared:
+            # Слияние в самом хранилище: не затираем поля, измененные другим воркером
+            self.backend.update(user_id, step, data, time.time())
+            return
+
+        stripe = user_id % self.stripes
+        if user_id not in self.shards[stripe]:
+            self._load(user_id)
+
+        now = time.time()
+        with self.locks[stripe]:
             # Создаем сессию если нужно
-            if user_id not in self.sessions:
-                self.sessions[user_id] = {
-                    'step': None,
-                    'data': {},
-                    'created_at': time.time(),
-                    'updated_at': time.time()
-                }
-            
-            session = self.sessions[user_id]
-            
+            session = self.shards[stripe].get(user_id)
+            is_new = session is None
+            if is_new:
+                session = self.shards[stripe][user_id] = Session(created_at=now)
+
             if step is not None:
-                session['step'] = step
-            
+                session.step = step
+
             if data:
-                session['data'].update(data)
-            
-            session['updated_at'] = time.time()
+                session.data.update(data)
+
+            session.updated_at = now
+            self.backend.save(user_id, session)
+
+        if is_new:
+            self._index(user_id, now)
 
     def get_user_step(self, user_id: int) -> Optional[str]:
-        with self.lock:
-            session = self.sessions.get(user_id)
-            return session['step'] if session else None
+        session = self._lookup(user_id)
+        return session.step if session else None
 
     def get_user_data(self, user_id: int, key: Optional[str] = None) -> Any:
-        with self.lock:
-            session = self.sessions.get(user_id)
-            if not session:
-                return None
-            return session['data'].get(key) if key else session['data']
+        session = self._lookup(user_id)
+        if not session:
+            return None
+        return session.data.get(key) if key else session.data
+
+    def get_step_and_data(self, user_id: int) -> Tuple[Optional[str], Optional[Dict[str, Any]]]:
+        """Шаг и данные сессии одним поиском; (None, None), если сессии нет"""
+        session = self._lookup(user_id)
+        if not session:
+            return None, None
+        return session.step, session.data
 
     def clear_session(self, user_id: int) -> None:
-        with self.lock:
-            if user_id in self.sessions:
-                del self.sessions[user_id]
+        stripe = user_id % self.stripes
+        with self.locks[stripe]:
+            self.shards[stripe].pop(user_id, None)
+            self.backend.delete(user_id)
+
+    def close(self) -> None:
+        """Дописывает отложенные изменения в хранилище"""
+        self.backend.close()
+
+    def __len__(self) -> int:
+        if self.backend.shared:
+            return self.backend.count(time.time() - self.session_timeout)
+        return sum(len(shard) for shard in self.shards)
+
+    def _evict(self, current_time: float) -> int:
+        """ Удаляет истекшие сессии и, пока сессий больше max_sessions, давно не использованные.
+            Вызывается под expiry_lock, возвращает число удаленных сессий
+        """
+        removed = 0
+        count = len(self)
+
+        while self.expiry_heap:
+            stamp, user_id = self.expiry_heap[0]
+            if current_time - stamp <= self.session_timeout and count <= self.max_sessions:
+                break
+
+            heapq.heappop(self.expiry_heap)
+            stripe = user_id % self.stripes
+            with self.locks[stripe]:
+                session = self.shards[stripe].get(user_id)
+                # Запись от удаленной сессии или от прежней сессии того же пользователя
+                if session is None or session.created_at > stamp:
+                    continue
+                if session.updated_at > stamp:
+                    heapq.heappush(self.expiry_heap, (session.updated_at, user_id))
+                    continue
+                del self.shards[stripe][user_id]
+                # Вытесненная по лимиту памяти сессия остается в хранилище и вернется при обращении
+                if current_time - session.updated_at > self.session_timeout:
+                    self.backend.delete(user_id)
+
+            removed += 1
+            count -= 1
+
+        return removed
 
     def _cleanup_expired(self):
-        with self.lock:
-            current_time = time.time()
-            expired_users = [
-                user_id for user_id, session in self.sessions.items()
-                if current_time - session['updated_at'] > self.session_timeout
-            ]
-            for user_id in expired_users:
-                del self.sessions[user_id]
-            if expired_users:
-                print(f"🧹 Очищено {len(expired_users)} устаревших сессий")
\ No newline at end of file
+        if self.backend.shared:
+            self.backend.purge(time.time() - self.session_timeout)
+            return
+
+        with self.expiry_lock:
+            removed = self._evict(time.time())
+        if removed:
+            print(f"🧹 Очищено {removed} устаревших сессий")
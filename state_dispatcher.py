@@ -0,0 +1,71 @@
+from typing import Any, Awaitable, Callable, Dict, Iterable, Optional, Tuple
+
+# Событие текстового сообщения; событие нажатия кнопки - префикс callback_data до двоеточия
+TEXT_EVENT = 'text'
+
+# Маршрут для любого шага, кроме отсутствия сессии
+ANY_STEP = '*'
+
+Handler = Callable[[Any], Awaitable[Any]]
+
+
+def callback_event(data: str) -> str:
+    """'param_change:target_ac' -> 'param_change', 'calculate' -> 'calculate'"""
+    return data.partition(':')[0]
+
+
+def editing_step(param_slug: str) -> str:
+    """Шаг ввода нового значения параметра из меню"""
+    return f'editing_{param_slug}'
+
+
+def build_parameter_transitions(parameters: Dict[str, Dict[str, Any]]) -> Dict[str, str]:
+    """ Переходы меню параметров: {шаг ввода параметра: событие, которое его завершает}.
+        Текстовые параметры ждут сообщения, параметры с кнопками - нажатия с их callback_prefix.
+        Флаги и варианты переключаются сразу и своего шага не имеют
+    """
+    transitions = {}
+    for param_slug, param_data in parameters.items():
+        if param_data['type'] == 'user_text':
+            transitions[editing_step(param_slug)] = TEXT_EVENT
+        elif param_data['type'] == 'inline_button':
+            transitions[editing_step(param_slug)] = param_data['callback_prefix']
+
+    return transitions
+
+
+class StateDispatcher:
+    """ Маршрутизация обновлений по шагу диалога: шаг пользователя читается один раз на обновление,
+        обработчик находится в словаре по (шаг, событие). Время выбора не зависит
+        от числа шагов и обработчиков, в отличие от перебора фильтров
+    """
+
+    def __init__(self, get_step: Callable[[int], Optional[str]]):
+        self.get_step = get_step
+        self.routes: Dict[Tuple[Optional[str], str], Handler] = {}
+
+    def route(self, event: str, steps: Iterable[Optional[str]] = (ANY_STEP,)):
+        """Декоратор: обработчик события на перечисленных шагах (None - сессии нет)"""
+        def decorator(handler: Handler) -> Handler:
+            for step in steps:
+                if (step, event) in self.routes:
+                    raise ValueError(f'Маршрут ({step}, {event}) уже занят')
+                self.routes[(step, event)] = handler
+            return handler
+
+        return decorator
+
+    def resolve(self, step: Optional[str], event: str) -> Optional[Handler]:
+        handler = self.routes.get((step, event))
+        if handler is None and step is not None:
+            handler = self.routes.get((ANY_STEP, event))
+        return handler
+
+    async def dispatch(self, update, user_id: int, event: str) -> bool:
+        """Вызывает обработчик обновления; False - на этом шаге событие не обрабатывается"""
+        handler = self.resolve(self.get_step(user_id), event)
+        if handler is None:
+            return False
+
+        await handler(update)
+        return True
@@ -65,3 +65,20 @@ def generate_help_text():
     )
 
     return help_text
+
+
+def generate_sweep_text(labels, ac_values, matrix):
+    """Таблица среднего урона по вариантам билда для выбранных AC"""
+    # Ширина колонки по самой длинной подписи: подписи из нескольких параметров длиннее заголовка
+    width = max((len(label) for label in labels), default=0)
+    width = max(width, len("Вариант"))
+    header = f'{"Вариант":<{width}}' + ''.join(f'{f"AC{ac}":>7}' for ac in ac_values)
+    rows = [
+        f'{label:<{width}}' + ''.join(f'{damage:7.1f}' for damage in row)
+        for label, row in zip(labels, matrix)
+    ]
+
+    return (
+        "⚖️ <b>Средний урон за атаку по вариантам</b>\n"
+        f"<pre>{header}\n{chr(10).join(rows)}</pre>"
+    )
@@ -0,0 +1,116 @@
+""" Прием обновлений Telegram через вебхук вместо long polling.
+
+    Локальный HTTP-сервер на aiohttp принимает POST с JSON обновления и кладет его
+    в ограниченную очередь, из которой обновления разбирают воркеры бота.
+    Если очередь заполнена, сервер отвечает 503 и Telegram повторит доставку позже.
+
+    Проверка без Telegram - отправить записанное обновление:
+    curl -X POST localhost:8443/webhook -H 'Content-Type: application/json' -d @update.json
+"""
+import asyncio
+import hmac
+import json
+from typing import Optional
+
+from aiohttp import web
+from telebot.types import Update
+
+# Заголовок с секретом, который Telegram передает в каждом запросе вебхука
+SECRET_HEADER = 'X-Telegram-Bot-Api-Secret-Token'
+
+
+class WebhookServer:
+    """ Вебхук-сервер: очередь на max_queue обновлений и workers задач-обработчиков.
+        url - публичный адрес для setWebhook; без него вебхук в Telegram не регистрируется
+        (удобно для локальной проверки записанными обновлениями)
+    """
+
+    def __init__(self, bot, host: str = '127.0.0.1', port: int = 8443, path: str = '/webhook',
+                 url: str = '', secret_token: str = '', max_queue: int = 256, workers: int = 16,
+                 metrics=None):
+        self.bot = bot
+        self.host = host
+        self.port = port
+        self.path = path
+        self.url = url
+        self.secret_token = secret_token
+        self.max_queue = max_queue
+        self.workers = workers
+        self.metrics = metrics
+        self.queue: Optional[asyncio.Queue] = None
+        self.runner: Optional[web.AppRunner] = None
+        self.tasks = []
+
+        if metrics is not None:
+            metrics.describe('webhook_updates_total', 'Обновления, принятые вебхуком, по результату')
+            metrics.gauge('webhook_queue', 'Обновлений в очереди вебхука',
+                          lambda: self.queue.qsize() if self.queue else 0)
+
+    def _count(self, result: str) -> None:
+        if self.metrics is not None:
+            self.metrics.increment('webhook_updates_total', result=result)
+
+    async def handle_update(self, request: web.Request) -> web.Response:
+        if self.secret_token and not hmac.compare_digest(request.headers.get(SECRET_HEADER, ''), self.secret_token):
+            self._count('forbidden')
+            return web.Response(status=403)
+
+        try:
+            update = Update.de_json(await request.json())
+        except (json.JSONDecodeError, KeyError, TypeError, ValueError):
+            self._count('invalid')
+            return web.Response(status=400, text='invalid update')
+
+        try:
+            self.queue.put_nowait(update)
+        except asyncio.QueueFull:
+            # Обратное давление: Telegram повторит доставку, а очередь не растет без предела
+            self._count('rejected')
+            return web.Response(status=503, headers={'Retry-After': '1'})
+
+        self._count('accepted')
+        return web.Response()
+
+    async def _worker(self) -> None:
+        while True:
+            update = await self.queue.get()
+            try:
+                await self.bot.process_new_updates([update])
+            except Exception as e:
+                print(f"❌ Ошибка обработки обновления {update.update_id}: {e}")
+            finally:
+                self.queue.task_done()
+
+    async def start(self) -> None:
+        self.queue = asyncio.Queue(maxsize=self.max_queue)
+        self.tasks = [asyncio.create_task(self._worker()) for _ in range(self.workers)]
+
+        app = web.Application()
+        app.router.add_post(self.path, self.handle_update)
+        self.runner = web.AppRunner(app, access_log=None)
+        await self.runner.setup()
+        await web.TCPSite(self.runner, self.host, self.port).start()
+
+        if self.url:
+            await self.bot.set_webhook(
+                url=self.url.rstrip('/') + self.path,
+                secret_token=self.secret_token or None,
+                max_connections=min(self.workers, 100)
+            )
+
+    async def stop(self) -> None:
+        """Дожидается разбора принятых обновлений и останавливает сервер"""
+        if self.runner is not None:
+            await self.runner.cleanup()
+        if self.queue is not None:
+            await self.queue.join()
+        for task in self.tasks:
+            task.cancel()
+        await asyncio.gather(*self.tasks, return_exceptions=True)
+
+    async def serve_forever(self) -> None:
+        await self.start()
+        try:
+            await asyncio.Event().wait()
+        finally:
+            await self.stop()